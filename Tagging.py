@@ -11,6 +11,7 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
 import pathlib
+import bisect
 import datetime
 
 from ui import mainwindow
@@ -36,37 +37,71 @@ devs = []
 
 
 
+"""
+Running max/mean projection over all loaded videos.
+Each video is folded in once, as soon as its own projections are known, so adding a video
+only costs as much as that video. The mean is weighted by the number of frames per video
+and summed up in double precision.
+"""
+class ProjectionAggregate:
+    def __init__(self):
+        self.max = None
+        self.sum = None
+        self.count = 0
+        self.indices = set()
+    
+    def add(self, idx, vmax, vmean, frames):
+        # the same file loaded twice has the same projections
+        if idx in self.indices:
+            return
+        self.indices.add( idx )
+        if self.max is None:
+            self.max = np.array( vmax )
+            self.sum = frames*np.asarray( vmean, dtype=np.float64 )
+        else:
+            np.maximum( self.max, vmax, out=self.max )
+            self.sum += frames*np.asarray( vmean, dtype=np.float64 )
+        self.count += frames
+    
+    def mean(self):
+        return self.sum/self.count
+
+projections = ProjectionAggregate()
+
+
+
+# loaded videos in order and the global index of the first frame of each, plus the total
+# (call update_frame_index() whenever videos_loaded or videos change)
+loaded_video_indices = []
+frame_offsets = [0]
+
+def update_frame_index():
+    global loaded_video_indices, frame_offsets
+    loaded_video_indices = [ i for i in range(len(videos_loaded)) if videos_loaded[i] ]
+    frame_offsets = [0]
+    for i in loaded_video_indices:
+        frame_offsets.append( frame_offsets[-1] + videos[i].frames )
+
 def avail_frame_count():
-    res = 0
-    for i in range(len(videos_loaded)):
-        if videos_loaded[i]:
-            res += videos[i].frames
-    return res
+    return frame_offsets[-1]
 
 def indices_from_frame(f):
-    vi = 0
-    fi = f
-    if f < avail_frame_count():
-        for i in range(len(videos_loaded)):
-            if videos_loaded[i]:
-                if fi >= videos[i].frames:
-                    fi -= videos[i].frames
-                    vi += 1
-                else:
-                    return vi, fi
-            else:
-                vi += 1
+    if 0 <= f < avail_frame_count():
+        k = bisect.bisect_right( frame_offsets, f ) - 1
+        return loaded_video_indices[k], f - frame_offsets[k]
     else:
         return False # TODO: raise a proper Error
 
 def get_frame(f):
     if f < avail_frame_count():
         vi, fi = indices_from_frame(f)
+        # imshow scales the colours to the frame anyway, so the raw counts will do
+        # (normalizing would need the maximum, i.e. a pass over the whole file)
         return videos[vi].data[fi]
     else:
         return False # TODO: raise a proper Error
 
-def draw_guide_line( ax, x0, y0, alpha, dist, direction, shift, color ):
+def guide_line( x0, y0, alpha, dist, direction, shift ):
     if direction == 0:
         dx = np.cos( pi*alpha/180.0 )
         dy = np.sin( pi*alpha/180.0 )
@@ -97,7 +132,73 @@ def draw_guide_line( ax, x0, y0, alpha, dist, direction, shift, color ):
     xb = x0 + fwd*dx
     yb = y0 + fwd*dy
     
-    ax.plot( [xa, xb], [ya, yb], c=color, ls=':', lw=1 )
+    return [xa, xb], [ya, yb]
+
+# the order in which the guide lines are drawn, see guide_line
+GUIDE_LINES = [ (direction, shift) for shift in [0, -1, 1] for direction in [0, 1] ]
+
+
+
+"""
+Loads videos in a background thread, see MainWindow.load_videos.
+First, every file is opened lazily, which is quick and makes its frames available right away.
+Then the max/mean projections, which need to decode every frame, are computed for all files
+concurrently. Results are handed to the GUI thread through signals; cancel() stops the
+loader after the files that are currently being processed.
+Videos that are already open (given as { index : video }) are only projected.
+Failures are reported through error (index, or -1 if it's not about one file), and
+finished is emitted in any case.
+"""
+class VideoLoader(QtCore.QObject):
+    opened = QtCore.pyqtSignal(int, object)
+    projected = QtCore.pyqtSignal(int, object, object)
+    error = QtCore.pyqtSignal(int, str)
+    finished = QtCore.pyqtSignal()
+    
+    def __init__(self, descriptors, indices, workers=None, videos=None):
+        super(VideoLoader, self).__init__()
+        self.descriptors = descriptors
+        self.indices = indices
+        self.videos = videos if videos is not None else {}
+        # number of threads for the projections (None: tdms.LOAD_WORKERS)
+        self.workers = workers
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+    
+    def project(self, video):
+        if self.cancelled:
+            return None
+        return video.projections()
+    
+    def run(self):
+        try:
+            opened = []
+            for idx in self.indices:
+                if self.cancelled:
+                    break
+                video = self.videos.get( idx )
+                if video is None:
+                    # lazy: frames are only decoded when they are shown or projected
+                    # COMPACT: keep the camera counts as they are (unless they don't fit into 16 bits),
+                    #          normalization is applied on the fly
+                    try:
+                        video = tdms.Video().load( self.descriptors[idx], lazy=True, dtype=tdms.COMPACT )
+                    except Exception as e:
+                        self.error.emit( idx, "{t}: {e}".format(t=type(e).__name__, e=e) )
+                        continue
+                opened.append( ( idx, video ) )
+                self.opened.emit( idx, video )
+            
+            for i, projections in tdms.run_concurrently( self.project, [ video for idx, video in opened ], self.workers ):
+                if self.cancelled or projections is None:
+                    break
+                self.projected.emit( opened[i][0], projections[0], projections[1] )
+        except Exception as e:
+            self.error.emit( -1, "{t}: {e}".format(t=type(e).__name__, e=e) )
+        finally:
+            self.finished.emit()
 
 
 
@@ -131,6 +232,9 @@ class MainWindow(QtWidgets.QMainWindow):
         
         self.ui.exportButton.clicked.connect(self.export)
         
+        self.loader = None
+        self.loader_thread = None
+        
         self.video_items = []
         self.dev_items = []
         #self.selected_dev_items = []
@@ -144,6 +248,23 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ui.progressBar.setValue(0)
         self.ui.progressBar.setEnabled(False)
         
+        # not part of the .ui file, so it's added here
+        self.cancel_button = QtWidgets.QPushButton("Cancel Loading")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_loading)
+        self.ui.verticalLayout_7.addWidget(self.cancel_button)
+        
+        # number of threads that compute the projections, 0 means automatic (see tdms.LOAD_WORKERS)
+        self.workers_spinbox = QtWidgets.QSpinBox()
+        self.workers_spinbox.setMinimum(0)
+        self.workers_spinbox.setMaximum(64)
+        self.workers_spinbox.setSpecialValueText("Auto")
+        self.workers_spinbox.setValue(0)
+        workers_layout = QtWidgets.QHBoxLayout()
+        workers_layout.addWidget( QtWidgets.QLabel("Loader Threads") )
+        workers_layout.addWidget( self.workers_spinbox )
+        self.ui.verticalLayout_7.addLayout(workers_layout)
+        
         # Video view and control
         self.ui.horizontalSlider.setMinimum(0)
         self.ui.horizontalSlider.setMaximum( avail_frame_count() )
@@ -177,9 +298,24 @@ class MainWindow(QtWidgets.QMainWindow):
         #layout.addWidget(self.image_toolbar)
         layout.addWidget(self.image_canvas)
         self.ui.plotWidget.setLayout(layout)
+        
+        # the image and the guide lines are created once (see setup_image_plot) and then only
+        # updated and blitted onto a cached background
+        self.image_axes = None
+        self.image_artist = None
+        self.guide_artists = []
+        self.image_background = None
+        self.image_canvas.mpl_connect('draw_event', self.image_drawn)
+        
+        # redraw requests are coalesced to at most one per display refresh
+        self.redraw_timer = QtCore.QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        refresh_rate = QtWidgets.QApplication.primaryScreen().refreshRate()
+        self.redraw_timer.setInterval( int( 1000/refresh_rate ) if refresh_rate > 0 else 16 )
+        self.redraw_timer.timeout.connect(self.redraw_image)
     
     def select_input_files(self):
-        global obj_dsc, videos_loaded, videos, videos_width, videos_height
+        global obj_dsc, videos_loaded, videos, projections, vdata_max, vdata_mean, videos_width, videos_height
         
         videos_width = NOT_INITIALIZED
         videos_height = NOT_INITIALIZED
@@ -192,9 +328,13 @@ class MainWindow(QtWidgets.QMainWindow):
             obj_dsc.videos = tdms.files_to_descriptors(files)
             videos_loaded = []
             videos = []
+            projections = ProjectionAggregate()
+            vdata_max = np.zeros( (1,1,1) )
+            vdata_mean = np.zeros( (1,1,1) )
             for i in range(len(obj_dsc.videos)):
                 videos_loaded.append(False)
                 videos.append( tdms.Video() )
+            update_frame_index()
             
             self.show_video_descriptors()
             self.input_files_selected = True
@@ -254,31 +394,64 @@ class MainWindow(QtWidgets.QMainWindow):
         self.load_videos( range(len(obj_dsc.videos)) )
     
     def load_videos(self, indices):
-        global videos, videos_loaded, obj_dsc, videos_width, videos_height
-        #print("video_descriptors:\t{l}".format(l = len(obj_dsc.videos)))
-        #print("videos_loaded:\t{l}".format(l = len(videos_loaded)))
-        #print("videos:\t{l}".format(l = len(videos)))
-        
-        if indices:
+        if indices and self.loader is None:
+            # negative indices (e.g. "last video") are resolved here, the loader only gets the real ones,
+            # and only those that aren't both loaded and projected yet;
+            # videos that are open already (e.g. after cancelling) are only projected
+            resolved = []
+            for idx in indices:
+                idx = idx % len(obj_dsc.videos)
+                if not ( ( videos_loaded[idx] and idx in projections.indices ) or idx in resolved ):
+                    resolved.append( idx )
+            indices = resolved
+            reopened = { idx:videos[idx] for idx in indices if videos_loaded[idx] }
+            if not indices:
+                return
+            
+            # one step when a file has been opened, one when its projections are done
             self.ui.progressBar.setEnabled(True)
             self.ui.progressBar.setMinimum(0)
-            self.ui.progressBar.setMaximum(len(indices))
-            pos = 0
-            self.ui.progressBar.setValue( pos )
+            self.ui.progressBar.setMaximum(2*len(indices))
+            self.ui.progressBar.setValue( 0 )
+            for btn in [ self.ui.pushButton, self.ui.pushButton_3, self.ui.pushButton_4, self.ui.pushButton_6 ]:
+                btn.setEnabled(False)
+            self.cancel_button.setEnabled(True)
             
-            for idx in indices:
-                videos[idx].load( obj_dsc.videos[idx] )
-                videos_loaded[idx] = True
-                if videos_width == NOT_INITIALIZED:
-                    videos_width = videos[idx].width
-                    videos_height = videos[idx].height
-                else:
-                    if not ( (videos_width == videos[idx].width) and (videos_height == videos[idx].height) ):
-                        print( "WARNING: video {i} does not have the same dimensions as the previously loaded data!".format(i=idx) )
-                        videos_loaded[idx] = False
-                        # TODO: actually handle the error
-                pos += 1
-                self.ui.progressBar.setValue( pos )
+            workers = self.workers_spinbox.value()
+            self.loader = VideoLoader( obj_dsc.videos, indices, workers if workers > 0 else None, reopened )
+            self.loader_thread = QtCore.QThread()
+            self.loader.moveToThread( self.loader_thread )
+            self.loader_thread.started.connect( self.loader.run )
+            self.loader.opened.connect( self.video_opened )
+            self.loader.projected.connect( self.video_projected )
+            self.loader.error.connect( self.loading_failed )
+            self.loader.finished.connect( self.loading_finished )
+            self.loader_thread.start()
+    
+    def cancel_loading(self):
+        if self.loader is not None:
+            self.loader.cancel()
+            self.cancel_button.setEnabled(False)
+    
+    # a video has been opened by the loader; its frames can be shown from now on
+    def video_opened(self, idx, video):
+        global videos, videos_loaded, obj_dsc, videos_width, videos_height
+        
+        # release the file of a video this one replaces
+        if videos[idx] is not video:
+            videos[idx].close()
+        videos[idx] = video
+        videos_loaded[idx] = True
+        first = ( videos_width == NOT_INITIALIZED )
+        if first:
+            videos_width = videos[idx].width
+            videos_height = videos[idx].height
+        else:
+            if not ( (videos_width == videos[idx].width) and (videos_height == videos[idx].height) ):
+                print( "WARNING: video {i} does not have the same dimensions as the previously loaded data!".format(i=idx) )
+                videos_loaded[idx] = False
+                # TODO: actually handle the error
+        update_frame_index()
         
         # debug output
         """
@@ -291,25 +464,13 @@ class MainWindow(QtWidgets.QMainWindow):
                 print("  not loaded")
         """
         
-        if indices:
-            maxs = []
-            means = []
-            for i in range(len(obj_dsc.videos)):
-                if videos_loaded[i]:
-                    maxs.append( np.max( videos[i].data, axis=0 ) )
-                    means.append( np.mean( videos[i].data, axis=0 ) )
-            
-            global vdata_max, vdata_mean
-            vdata_max = np.max( np.array(maxs), axis=0)
-            vdata_mean = np.mean( np.array(means) , axis=0)
-            
+        if first:
             obj_dsc.x = int( videos_width / 2 )
             obj_dsc.y = int( videos_height / 2 )
-            #print( vdata_max.size )
             obj_dsc.angle = -1.0*self.ui.doubleSpinBox_alpha.value()
             #obj_dsc.angle = 180.0
-            if obj_dsc.roi_width > np.min( vdata_max.size ):
-                obj_dsc.roi_width = np.min( vdata_max.size )
+            if obj_dsc.roi_width > np.min( [ videos_width, videos_height ] ):
+                obj_dsc.roi_width = np.min( [ videos_width, videos_height ] )
             
             self.ui.horizontalScrollBar.setMinimum(0)
             self.ui.horizontalScrollBar.setMaximum(videos_width-1)
@@ -321,7 +482,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.ui.verticalScrollBar.setValue( obj_dsc.y )
             self.ui.doubleSpinBox_y0.setMaximum(videos_height-1)
         
-        self.ui.progressBar.setEnabled(False)
+        self.ui.progressBar.setValue( self.ui.progressBar.value()+1 )
         
         # set paramters to the frame scrub slider and other control elements
         self.ui.horizontalSlider.setMinimum(0)
@@ -330,6 +491,46 @@ class MainWindow(QtWidgets.QMainWindow):
         
         self.plot_image()
     
+    # the loader has computed the max/mean projections of a video
+    def video_projected(self, idx, vmax, vmean):
+        global vdata_max, vdata_mean
+        
+        self.ui.progressBar.setValue( self.ui.progressBar.value()+1 )
+        if not videos_loaded[idx]:
+            return
+        projections.add( idx, vmax, vmean, videos[idx].frames )
+        
+        vdata_max = projections.max
+        vdata_mean = projections.mean()
+        
+        if not video_view_mode == "Frame":
+            self.plot_image()
+    
+    def loading_failed(self, idx, message):
+        if idx < 0:
+            print( "WARNING: loading stopped: {m}".format(m=message) )
+        else:
+            print( "WARNING: video {i} could not be loaded: {m}".format(i=idx, m=message) )
+    
+    def loading_finished(self):
+        self.loader_thread.quit()
+        self.loader_thread.wait()
+        self.loader = None
+        self.loader_thread = None
+        
+        self.ui.progressBar.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+        for btn in [ self.ui.pushButton, self.ui.pushButton_3, self.ui.pushButton_4, self.ui.pushButton_6 ]:
+            btn.setEnabled(True)
+    
+    def closeEvent(self, event):
+        # don't pull the rug from under a running loader
+        if self.loader is not None:
+            self.loader.cancel()
+            self.loader_thread.quit()
+            self.loader_thread.wait()
+        super(MainWindow, self).closeEvent(event)
+    
     def change_video_view_mode(self):
         global video_view_mode
         video_view_mode = self.ui.comboBox_2.currentText()
@@ -391,35 +592,75 @@ class MainWindow(QtWidgets.QMainWindow):
             self.plot_image()
     
     def plot_image(self):
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start()
+    
+    def current_image(self):
+        if video_view_mode == "Maximum" and vdata_max.ndim < 3:
+            return vdata_max
+        elif video_view_mode == "Mean" and vdata_mean.ndim < 3:
+            return vdata_mean
+        # frame mode, or the projections are still being computed
+        elif current_frame < avail_frame_count():
+            return get_frame(current_frame)
+        else:
+            return None
+    
+    def setup_image_plot(self, shape):
+        self.image_figure.clear()
+        #self.image_figure.set_facecolor('black')
+        ax = self.image_figure.add_subplot(111)
+        self.image_figure.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=None, hspace=None)
+        ax.set_axis_off()
+        
+        # animated artists are left out of regular draws, they are blitted in redraw_image
+        self.image_artist = ax.imshow( np.zeros(shape), cmap="jet", animated=True )
+        self.guide_artists = [ ax.plot( [0, 0], [0, 0], c='w', ls=':', lw=1, animated=True )[0] for line in GUIDE_LINES ]
+        
+        ax.set_xlim( [ -0.5, shape[1]-0.5 ] )
+        ax.set_ylim( [ shape[0]-0.5, -0.5 ] )
+        self.image_axes = ax
+        self.image_background = None
+    
+    # full redraw of the canvas (first plot, resize, ...): keep the empty axes as the background
+    def image_drawn(self, event):
+        if self.image_axes is not None:
+            self.image_background = self.image_canvas.copy_from_bbox( self.image_figure.bbox )
+            self.draw_image_artists()
+    
+    def draw_image_artists(self):
+        self.image_axes.draw_artist( self.image_artist )
+        for artist in self.guide_artists:
+            self.image_axes.draw_artist( artist )
+    
+    def redraw_image(self):
         if avail_frame_count() > 0:
-            self.image_figure.clear()
-            #self.image_figure.set_facecolor('black')
-            ax = self.image_figure.add_subplot(111)
-            self.image_figure.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=None, hspace=None)
+            data = self.current_image()
+            if data is None:
+                return
             
-            ax.set_axis_off()
+            if self.image_artist is None or self.image_artist.get_array().shape != data.shape:
+                self.setup_image_plot( data.shape )
             
-            if video_view_mode == "Frame":
-                #vi, fi = indices_from_frame(current_frame)
-                im = ax.imshow( get_frame(current_frame) , cmap="jet")
-            elif video_view_mode == "Maximum":
-                im = ax.imshow( vdata_max , cmap="jet")
-            elif video_view_mode == "Mean":
-                im = ax.imshow( vdata_mean , cmap="jet")
+            self.image_artist.set_data( data )
+            # scale the colours to the image, like imshow does
+            self.image_artist.autoscale()
             
-            # draw crosshairs
+            # crosshairs
             x0, y0 = obj_dsc.x, obj_dsc.y
             alpha = obj_dsc.angle
             dist = 0.5*(obj_dsc.roi_width-1)
+            for artist, (direction, shift) in zip( self.guide_artists, GUIDE_LINES ):
+                xs, ys = guide_line( x0, y0, alpha, dist, direction, shift )
+                artist.set_data( xs, ys )
             
-            for shift in [0, -1, 1]:
-                for direction in [0, 1]:
-                    draw_guide_line( ax, x0, y0, alpha, dist, direction, shift, 'w' )
-            
-            ax.set_xlim( [ -0.5, videos_width-0.5 ] )
-            ax.set_ylim( [ videos_height-0.5, -0.5 ] )
-            
-            self.image_canvas.draw()
+            if self.image_background is None:
+                # draw_event -> image_drawn takes care of the rest
+                self.image_canvas.draw()
+            else:
+                self.image_canvas.restore_region( self.image_background )
+                self.draw_image_artists()
+                self.image_canvas.blit( self.image_figure.bbox )
     
     def load_devices(self):
         global devs
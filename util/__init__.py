@@ -1,8 +1,29 @@
-
-from util.tdms import Video
-#from util.objects import Object
-from util.devices import SpectrometerDataSet, Device
+import importlib
 
 
 calibration_persistent_data_path = "persistent/calibration/"
 
+
+# Submodules and the classes exported here are only imported when they are first used
+# (PEP 562), so "import util" doesn't pay for scipy, nptdms, skimage, matplotlib, ...
+# e.g. util.Device imports util.devices, util.bfp imports util.bfp.
+exports = {
+    'Video':'util.tdms',
+    #'Object':'util.objects',
+    'SpectrometerDataSet':'util.devices',
+    'Device':'util.devices',
+}
+submodules = [ 'bfp', 'colour', 'devices', 'mie_library', 'mie_theory', 'objects', 'plotstyle', 'schematics', 'tdms' ]
+
+def __getattr__(name):
+    if name in exports:
+        value = getattr( importlib.import_module( exports[name] ), name )
+    elif name in submodules:
+        value = importlib.import_module( "util.{m}".format(m=name) )
+    else:
+        raise AttributeError( "module 'util' has no attribute '{n}'".format(n=name) )
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted( list(globals()) + list(exports) + submodules )
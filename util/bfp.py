@@ -2,14 +2,12 @@
 # For math things
 import numpy as np
 import numpy.typing
-import scipy.signal
 #from scipy import interpolate
 # used once in interpolation
 # TODO: maybe find the numpy equivalent to improve performace
 import math
 
-# For reading TIFF files
-import skimage.io
+# For reading TIFF files: skimage.io, imported in TIFF_Stack.load_file (it's slow to import)
 
 from enum import Flag, auto
 
@@ -33,6 +31,7 @@ class PrimitiveImageROI:
         self.ymax = 0
         self.xmean = 0.0
         self.ymean = 0.0
+        self.area = 0
         for kw in kwargs:
             if kw in ['xmin', 'left']:
                 self.xmin = kwargs[kw]
@@ -134,18 +133,280 @@ class TIFF_Metadata:
         res.conversion_factor = self.conversion_factor
         return res
     
+    """
+    Fills the metadata from the tags of a TIFF file, without reading any pixel data.
+    Camera software stores these in different places (ImageJ, Micro-Manager or JSON metadata,
+    key=value lines in the ImageDescription, ...), so all of them are searched for matching keys.
+    Values are taken as they are stored (e.g. Micro-Manager stores the exposure in ms).
+    """
     def load_file(self, fn):
+        import tifffile
+        with tifffile.TiffFile( fn ) as tif:
+            series = tif.series[0]
+            shape = tuple( series.shape )
+            if len(shape) == 2:
+                shape = (1,) + shape
+            self.frames, self.height, self.width = shape[-3:]
+            
+            page = tif.pages[0]
+            values = {}
+            for tag in page.tags.values():
+                if isinstance( tag.value, (str, int, float) ):
+                    values[tag.name] = tag.value
+            for attr in [ 'imagej_metadata', 'micromanager_metadata', 'shaped_metadata', 'ome_metadata' ]:
+                flatten_metadata( getattr( tif, attr, None ), values )
+            description = values.get( 'ImageDescription', "" )
+            for line in description.splitlines():
+                for sep in [ '=', ':' ]:
+                    if sep in line:
+                        key, value = line.split( sep, 1 )
+                        values.setdefault( key.strip(), value.strip() )
+                        break
+        
+        for key, value in values.items():
+            k = key.lower().replace( ' ', '' ).replace( '_', '' ).replace( '-', '' )
+            if 'exposure' in k:
+                self.exposure = leading_number( value, self.exposure )
+            elif 'delay' in k:
+                self.delay = leading_number( value, self.delay )
+            elif 'binning' in k:
+                bx, by = parse_binning( value, self.binningx, self.binningy, k )
+                self.binningx, self.binningy = bx, by
+            elif 'pixelrate' in k or 'pxrate' in k or 'readoutrate' in k:
+                self.px_rate = leading_number( value, self.px_rate )
+            elif 'irsensitivity' in k:
+                self.ir_sensitivity = str( value ).strip().lower() in [ '1', 'on', 'true', 'yes' ]
+            elif 'conversionfactor' in k:
+                self.conversion_factor = leading_number( value, self.conversion_factor )
+            elif k in [ 'camera', 'cameratype', 'cameraname', 'model' ]:
+                self.camera_type = str( value )
+        return self
+
+# flat { key : value } from nested (dict/list) metadata
+def flatten_metadata(metadata, values):
+    if isinstance( metadata, dict ):
+        for key, value in metadata.items():
+            if isinstance( value, (dict, list, tuple) ):
+                flatten_metadata( value, values )
+            else:
+                values.setdefault( str(key), value )
+    elif isinstance( metadata, (list, tuple) ):
+        for item in metadata:
+            flatten_metadata( item, values )
+    return values
+
+# the number at the start of a value like 12.5, "12.5" or "100 MHz"; default if there is none
+def leading_number(value, default):
+    if isinstance( value, (int, float) ) and not isinstance( value, bool ):
+        return float( value )
+    number = ""
+    for c in str( value ).strip():
+        if c.isdigit() or c in '.-+eE' and not ( c in 'eE' and not number ):
+            number += c
+        else:
+            break
+    try:
+        return float( number )
+    except ValueError:
+        return default
+
+# binning like 2, "2", "2x2" or "1 x 4"; the key tells whether it's only one of the axes
+def parse_binning(value, bx, by, key):
+    parts = [ leading_number( part, None ) for part in str( value ).lower().replace( ' ', '' ).split( 'x' ) ]
+    parts = [ int(part) for part in parts if part is not None ]
+    if not parts:
+        return bx, by
+    if key.endswith( 'binningx' ) or key.endswith( 'binx' ) or key.endswith( 'horizontalbinning' ):
+        return parts[0], by
+    if key.endswith( 'binningy' ) or key.endswith( 'biny' ) or key.endswith( 'verticalbinning' ):
+        return bx, parts[0]
+    return parts[0], parts[-1]
+
+# frames are read from TIFF files (and accumulated) in chunks of about this many bytes of float64 data
+CHUNK_BYTES = 2**27
+
+# width (in px) of the gaussian that smoothes the background profiles in SliceDataset.correct_top_bottom_bg(),
+# the kernel is cut off at sqrt(2) of that width
+BG_SMOOTHING_SIGMA = np.sqrt(128)
+
+"""
+Frames of a TIFF file, decoded page by page when they are accessed.
+Indexing works like on the (frames, height, width) array the file contains, e.g. pages[3] or pages[10:20, 5:50].
+"""
+class TIFF_Pages:
+    def __init__(self, fn:str, dtype=None):
+        import tifffile
+        self.file = tifffile.TiffFile( fn )
+        self.series = self.file.series[0]
+        self.shape = tuple( self.series.shape )
+        if len(self.shape) == 2:
+            self.shape = (1,) + self.shape
+        self.dtype = np.dtype( self.series.dtype if dtype is None else dtype )
+        self.ndim = 3
+        # uncompressed, contiguous pixel data is memory-mapped, anything else is decoded page by page
+        self.mapped = None
+        if self.series.dataoffset is not None:
+            try:
+                self.mapped = tifffile.memmap( fn, mode='r' ).reshape( self.shape )
+            except ValueError:
+                self.mapped = None
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def read(self, begin:int, end:int):
+        if end <= begin:
+            return np.zeros( (0,) + self.shape[1:], dtype=self.dtype )
+        if self.mapped is not None:
+            return np.array( self.mapped[begin:end], dtype=self.dtype )
+        data = self.file.asarray( key=range(begin, end), series=0 )
+        return data.reshape( (end-begin,) + self.shape[1:] ).astype( self.dtype, copy=False )
+    
+    def __getitem__(self, key):
+        if self.mapped is not None:
+            return np.array( self.mapped[key], dtype=self.dtype )
+        if not isinstance( key, tuple ):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if isinstance( first, (int, np.integer) ):
+            f = int(first) + ( self.shape[0] if first < 0 else 0 )
+            if not 0 <= f < self.shape[0]:
+                raise IndexError( "frame {f} out of range".format(f=first) )
+            return self.read( f, f+1 )[0][rest]
+        if isinstance( first, slice ):
+            begin, end, step = first.indices( self.shape[0] )
+            if step == 1:
+                return self.read( begin, end )[(slice(None),) + rest]
+            first = np.arange( begin, end, step )
+        idxs = np.asarray( first )
+        frames = np.stack( [ self.read( int(i), int(i)+1 )[0] for i in idxs.reshape(-1) ] ) if idxs.size else np.zeros( (0,) + self.shape[1:], dtype=self.dtype )
+        return frames.reshape( idxs.shape + self.shape[1:] )[(slice(None),)*idxs.ndim + rest]
+    
+    def __array__(self, dtype=None, copy=None):
+        data = self.read( 0, self.shape[0] )
+        return data if dtype is None else data.astype( dtype, copy=False )
+    
+    def close(self):
+        self.mapped = None
+        self.file.close()
+
+"""
+Running max, mean and variance over the frames of a stack, fed with chunks of frames
+(Welford's algorithm, merged chunk-wise as in Chan et al.; float64 accumulators).
+"""
+class RunningStatistics:
+    def __init__(self):
+        self.count = 0
+        self.max = None
+        self.mean = None
+        self.M2 = None
+    
+    def add(self, chunk):
+        n = chunk.shape[0]
+        if n == 0:
+            return self
+        chunk = np.asarray( chunk, dtype=np.float64 )
+        chunk_max = np.max( chunk, axis=0 )
+        chunk_mean = np.mean( chunk, axis=0 )
+        # deviations in a new array, chunk may be a view of the caller's data
+        deviations = chunk - chunk_mean
+        chunk_M2 = np.einsum( 'i...,i...->...', deviations, deviations )
+        if self.count == 0:
+            self.max, self.mean, self.M2 = chunk_max, chunk_mean, chunk_M2
+        else:
+            total = self.count + n
+            delta = chunk_mean - self.mean
+            np.maximum( self.max, chunk_max, out=self.max )
+            self.mean += delta*(n/total)
+            self.M2 += chunk_M2 + np.square(delta)*(self.count*n/total)
+        self.count += n
         return self
+    
+    def var(self):
+        return self.M2/self.count
+    
+    def std(self):
+        return np.sqrt( self.var() )
 
 class TIFF_Stack:
     def __init__(self):
         self.metadata = TIFF_Metadata()
         self.data = np.zeros( (1,1,1) )
+        # maximum of the data, only computed when it's needed (see normalization())
+        self.peak = None
     
-    def load_file(self, fn:str):
-        self.data = skimage.io.imread( fn )
+    """
+    dtype=None keeps whatever the file contains (usually uint16 counts), otherwise the data is converted,
+    e.g. to np.float32. The data is never normalized on load, use normalized() for that.
+    With lazy=True, nothing is decoded yet: data is a TIFF_Pages object which reads the frames
+    when they're accessed (from a memory map, if the file allows), and the stack is processed
+    in chunks (see frame_chunks()). Opening a file this way is instant, whatever its size.
+    """
+    def load_file(self, fn:str, dtype=None, lazy=False):
+        if lazy:
+            self.data = TIFF_Pages( fn, dtype )
+        else:
+            import skimage.io
+            self.data = skimage.io.imread( fn )
+            if dtype is not None:
+                self.data = self.data.astype( dtype, copy=False )
+        self.peak = None
+        self.metadata.load_file( fn )
         self.metadata.frames, self.metadata.height, self.metadata.width = self.data.shape
         return self
+    
+    # number of frames per chunk in frame_chunks()
+    def chunk_frames(self):
+        frame_bytes = 8*self.data.shape[1]*self.data.shape[2]
+        return max( 1, CHUNK_BYTES//frame_bytes )
+    
+    # consecutive chunks of frames, as arrays of shape (frames, height, width)
+    def frame_chunks(self, chunk_frames=None):
+        if chunk_frames is None:
+            chunk_frames = self.chunk_frames()
+        for begin in range( 0, self.data.shape[0], chunk_frames ):
+            yield self.data[ begin:begin+chunk_frames ]
+    
+    # max, mean and standard deviation over all frames, in one pass
+    def statistics(self):
+        stats = RunningStatistics()
+        for chunk in self.frame_chunks():
+            stats.add( chunk )
+        if self.peak is None and stats.count > 0:
+            self.peak = float( np.max( stats.max ) )
+        return stats
+    
+    def max_value(self):
+        if self.peak is None:
+            if isinstance( self.data, np.ndarray ):
+                self.peak = float( np.max(self.data) )
+            else:
+                self.peak = max( [ float( np.max(chunk) ) for chunk in self.frame_chunks() ] )
+        return self.peak
+    
+    # factor that turns self.data into values normalized to the maximum of the stack
+    def normalization(self):
+        return 1.0/self.max_value()
+    
+    def normalized(self, key=slice(None)):
+        return self.data[key]*self.normalization()
+    
+    # releases the file (and memory map) of a lazily loaded stack; its data can't be read afterwards
+    def close(self):
+        if isinstance( self.data, TIFF_Pages ):
+            self.data.close()
+    
+    """
+    So that a lazily loaded stack is closed once it's no longer needed:
+    with TIFF_Stack().load_file(fn, lazy=True) as tiff:
+        dataset.load_image_data( tiff )
+    """
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
 class Calibration:
     def __init__(self):
@@ -198,6 +459,7 @@ class SliceDataset:
         self.rois = []
         self.roi_mids = np.zeros( (1,1) )
         self.roi_devs = np.zeros( (1,1) )
+        self.roi_rows = np.zeros( (1), dtype=int )
         self.SLICE = PrimitiveImageROI()
         self.SMEAR = PrimitiveImageROI()
         self.TOPBG = PrimitiveImageROI()
@@ -226,9 +488,12 @@ class SliceDataset:
         return self
     
     def load_image_data(self, tiff:TIFF_Stack):
-        self.NORM_FAC = np.max(tiff.data)
-        self.img_data_avg = np.mean( tiff.data, axis=0 ) / self.NORM_FAC
-        self.img_data_std = np.std( tiff.data, axis=0 ) / self.NORM_FAC
+        # one pass over the stack, chunk by chunk, with float64 accumulators
+        # (with a lazily loaded stack, the whole stack is never in memory)
+        stats = tiff.statistics()
+        self.NORM_FAC = tiff.max_value()
+        self.img_data_avg = stats.mean / self.NORM_FAC
+        self.img_data_std = stats.std() / self.NORM_FAC
         
         self.metadata = tiff.metadata.copy()
         #self.metadata.frames = 1
@@ -247,76 +512,123 @@ class SliceDataset:
         return self
     
     def gen_mask(self):
+        from scipy import ndimage
+        
         # create a first mask: all points where the mean intensity is greater than sqrt2 times the standard deviation
         self.img_mask = np.where( self.img_data_avg > np.sqrt(2)*np.mean(self.img_data_avg, axis=None), 1, 0 )
         
         # now, find points among these that have enough neighbours to be unlikely to be due to noise
+        # (integer count of the 8 neighbours, zero outside of the image)
         NNEIGHBOURS = 3
         NITERATIONS = 2
-        IDWEIGHT = 16 # must be >8
-        kernel = np.array( [[ 1,    1    , 1 ],
-                            [ 1, IDWEIGHT, 1 ],
-                            [ 1,    1    , 1 ]] )
+        kernel = np.array( [[ 1, 1, 1 ],
+                            [ 1, 0, 1 ],
+                            [ 1, 1, 1 ]], dtype=np.uint8 )
         for i in range(NITERATIONS):
-            self.img_mask = np.where( scipy.signal.convolve2d(self.img_mask, kernel, mode='same')-IDWEIGHT >= NNEIGHBOURS, 1, 0 )
+            mask = self.img_mask.astype( np.uint8 )
+            neighbours = ndimage.correlate( mask, kernel, mode='constant', cval=0 )
+            self.img_mask = np.where( (mask > 0) & (neighbours >= NNEIGHBOURS), 1, 0 )
         
         return self
     
-    def gen_rois(self, ROI_MINIMUM_WIDTH=4):
-        # project the mask onto the x- and y-axes
-        xmask = np.where( np.sum(self.img_mask,axis=0)>2, 1, 0 )
-        ymask = np.where( np.sum(self.img_mask,axis=1)>2, 1, 0 )
-        
-        # rising and falling edges
-        xrising  =  np.clip( np.diff( xmask ),  0, 1 )
-        xfalling = -np.clip( np.diff( xmask ), -1, 0 )
-        yrising  =  np.clip( np.diff( ymask ),  0, 1 )
-        yfalling = -np.clip( np.diff( ymask ), -1, 0 )
+    """
+    Finds the ROIs in the mask: connected components (8-connectivity) are labelled, and those that
+    overlap in x are merged into one ROI, each with its own y-extent. The boundaries are padded like
+    the edges of the old projection-based detection: one pixel left, right and at the top.
+    Every ROI also gets the number of mask pixels in it (area) and its intensity-weighted centroid
+    (xmean, ymean).
+    """
+    def gen_rois(self, ROI_MINIMUM_WIDTH=4, ROI_MINIMUM_AREA=3):
+        from scipy import ndimage
+        
+        labels, count = ndimage.label( self.img_mask, structure=np.ones( (3,3) ) )
+        slices = ndimage.find_objects( labels )
+        
+        # per-component area and (intensity-weighted) moments, in one pass over the mask pixels
+        Y, X = np.nonzero( labels )
+        flat = labels[Y,X]-1
+        weights = self.img_data_avg[Y,X]
+        areas = np.bincount( flat, minlength=count )
+        wsum = np.bincount( flat, weights=weights, minlength=count )
+        wx = np.bincount( flat, weights=weights*X, minlength=count )
+        wy = np.bincount( flat, weights=weights*Y, minlength=count )
+        
+        # components sorted by x, merged while they overlap (or touch) in x
+        components = sorted( [ i for i in range(count) if areas[i] >= ROI_MINIMUM_AREA ], key=lambda i: slices[i][1].start )
+        merged = []
+        for i in components:
+            ys, xs = slices[i]
+            if merged and xs.start <= merged[-1]['xmax']+1:
+                m = merged[-1]
+                m['xmax'] = max( m['xmax'], xs.stop-1 )
+                m['ymin'] = min( m['ymin'], ys.start )
+                m['ymax'] = max( m['ymax'], ys.stop-1 )
+                for key, value in [ ('area', areas[i]), ('wsum', wsum[i]), ('wx', wx[i]), ('wy', wy[i]) ]:
+                    m[key] += value
+            else:
+                merged.append( { 'xmin':xs.start, 'xmax':xs.stop-1, 'ymin':ys.start, 'ymax':ys.stop-1,
+                                 'area':areas[i], 'wsum':wsum[i], 'wx':wx[i], 'wy':wy[i] } )
         
         # build R'sOI
+        height, width = labels.shape
         self.rois = []
-        maskstate = False
-        for x in range( xrising.shape[0] ):
-            if not maskstate:
-                if xrising[x] > 0.5:
-                    xmin = x
-                    maskstate = True
-            else:
-                if xfalling[x] > 0.5:
-                    xmax = x+1
-                    self.rois.append( PrimitiveImageROI( 
-                            xmin=xmin, 
-                            xmax=xmax, 
-                            ymin=np.min( np.nonzero(yrising) ), 
-                            ymax=np.max( np.nonzero(yfalling) ) 
-                        ) 
-                    )
-                    maskstate = False
+        for m in merged:
+            roi = PrimitiveImageROI( 
+                    xmin=max( m['xmin']-1, 0 ), 
+                    xmax=min( m['xmax']+1, width-1 ), 
+                    ymin=max( m['ymin']-1, 0 ), 
+                    ymax=m['ymax'] 
+                )
+            roi.area = int( m['area'] )
+            if m['wsum'] != 0:
+                roi.set_xmean( m['wx']/m['wsum'] )
+                roi.ymean = m['wy']/m['wsum']
+            self.rois.append( roi )
         
         # reject too narrow ROI's (probably only noise)
         self.rois = [ roi for roi in self.rois if roi.width()>=ROI_MINIMUM_WIDTH ]
         
         return self
     
-    def get_calibration(self):
+    """
+    Calibration from the line-wise mids of the R'sOI (the spectral orders) in self.img_data_avg,
+    or in img if given (e.g. a single frame, to track drift).
+    The moments of all lines and R'sOI are computed at once, as matrix products of the image lines
+    with a (columns x R'sOI) matrix of the x-coordinates relative to each ROI.
+    """
+    def get_calibration(self, img=None):
+        if img is None:
+            img = self.img_data_avg
+        
         # instance calibration wrapper object
         calibration = Calibration()
         calibration.lda_ref = 532.0
         calibration.lda_err = 0.0
         
-        # find line-wise mids for each ROI
-        mids = np.zeros( (len(self.rois), self.rois[0].height()) )
-        devs = np.zeros( (len(self.rois), self.rois[0].height()) )
-        
-        for i in range( len( self.rois ) ):
-            #X = np.arange(self.rois[i].width())
-            X = self.rois[i].X()
-            for y in range( self.rois[0].height() ):
-                norm      =          np.sum(            (self.rois[i](self.img_data_avg)[y]) )
-                mids[i,y] =          np.sum(            (self.rois[i](self.img_data_avg)[y]/norm)*(X) )
-                devs[i,y] = np.sqrt( np.sum( np.square( (self.rois[i](self.img_data_avg)[y]/norm)*(X-mids[i,y]) ) ) )
-            #mids[i] /= norm
-            #devs[i] /= norm
+        # find line-wise mids for each ROI, in the lines all R'sOI have in common
+        ymin = max( [ roi.ymin for roi in self.rois ] )
+        ymax = min( [ roi.ymax for roi in self.rois ] )
+        if ymax < ymin:
+            raise ValueError( "the R'sOI have no lines in common (y-ranges {r})".format( r=", ".join( [ "[{a}:{b}]".format(a=roi.ymin, b=roi.ymax) for roi in self.rois ] ) ) )
+        # the lines that roi_mids and roi_devs refer to
+        self.roi_rows = np.arange( ymin, ymax+1 )
+        lines = np.asarray( img[ymin:ymax+1], dtype=np.float64 )
+        
+        # membership and (ROI-relative) x-coordinates of every column for every ROI
+        M = np.zeros( (lines.shape[1], len(self.rois)) )
+        X = np.zeros( M.shape )
+        for i, roi in enumerate( self.rois ):
+            M[roi.xslice(),i] = 1.0
+            X[roi.xslice(),i] = np.arange( roi.width() )
+        xmin = np.array( [ roi.xmin for roi in self.rois ] )
+        
+        # mid = sum(p*X), dev = sqrt( sum( (p*(X-mid))^2 ) ) with p = line/norm
+        norm = lines @ M
+        mids = ( lines @ X )/norm
+        squares = np.square( lines )
+        devs = np.sqrt( np.abs( ( squares @ np.square(X) ) - 2*mids*( squares @ X ) + np.square(mids)*( squares @ M ) ) )/np.abs(norm)
+        mids = ( mids + xmin ).T
+        devs = devs.T
         
         """
         up to here, the result seem to be correct
@@ -324,56 +636,31 @@ class SliceDataset:
         
         # replace mids with too large of an uncertainty by the mean of the ones with sufficient confidence
         DEV_THRESHOLD = 4.0
-        midweights = np.zeros( devs.shape )
-        for i in range( len( self.rois ) ):
-            midweights[i] = np.where( devs[i] <= DEV_THRESHOLD, 1.0, 0.0 )
-            midweights[i] /= np.sum( midweights[i] )
-        #print(midweights[1])
+        midweights = np.where( devs <= DEV_THRESHOLD, 1.0, 0.0 )
+        midweights /= np.sum( midweights, axis=1, keepdims=True )
         meanmids = np.sum( mids*midweights, axis=1 )
         meandevs = np.sum( devs*midweights, axis=1 )
-        #print(meanmids)
-        #print(meandevs)
-        for i in range( len( self.rois ) ):
-            mids[i] = np.where( midweights[i]>0, mids[i], meanmids[i] )
-            devs[i] = np.where( midweights[i]>0, devs[i], meandevs[i] )
+        mids = np.where( midweights>0, mids, meanmids[:,None] )
+        devs = np.where( midweights>0, devs, meandevs[:,None] )
         
         self.roi_mids = np.copy(mids)
         self.roi_devs = np.copy(devs)
         
-        """
-        There's something happening here...
-        What it is ain't exactly clear...
-        """
-        
         """
         Interludium: Store the statistical mids for each ROI
         """
-        for i in range( len( self.rois ) ):
-            self.rois[i].set_xmean( np.mean(self.roi_mids[i]) )
-        
-        # compute relative offsets (w/ errors), line-by-line and for each roi
-        shift_ny = np.copy( mids[1:] )
-        shiftdev_ny = np.copy( devs[1:] )
-        for i in range( shift_ny.shape[0] ):
-            shift_ny[i] -= mids[0]
-            # adjust for different R'sOI
-            # (no longer necessary)
-            #shift_ny[i] += self.rois[i+1].xmin - self.rois[0].xmin
-            # divide by degree of separation
-            shift_ny[i] /= i+1
-            
-            # propagate error accordingly
-            shiftdev_ny[i] += devs[0]
-            shiftdev_ny[i] /= i+1
+        for roi, m in zip( self.rois, np.mean( self.roi_mids, axis=1 ) ):
+            roi.set_xmean( m )
         
-        # just a weighting function to assign weight n to the n-th order
-        shiftweight_ny = np.zeros( shift_ny.shape )
-        for i in np.arange(shift_ny.shape[0]):
-            shiftweight_ny[i] += i+1
+        # compute relative offsets (w/ errors), line-by-line and for each roi,
+        # divided by degree of separation (error propagated accordingly)
+        order = np.arange( 1, len(self.rois) )[:,None]
+        shift_ny = ( mids[1:] - mids[0] )/order
+        shiftdev_ny = ( devs[1:] + devs[0] )/order
         
-        # average over orders, result is only line-by-line
-        shift_y = np.sum( shift_ny*shiftweight_ny, axis=0 ) / np.sum( shiftweight_ny, axis=0 )
-        shiftdev_y = np.sum( shiftdev_ny*shiftweight_ny, axis=0 ) / np.sum( shiftweight_ny, axis=0 )
+        # average over orders, weighting the n-th order with n; result is only line-by-line
+        shift_y = np.sum( shift_ny*order, axis=0 ) / np.sum( order )
+        shiftdev_y = np.sum( shiftdev_ny*order, axis=0 ) / np.sum( order )
         
         # average over all lines (y-dimension) and write to calibration wrapper object
         calibration.px_ref = np.mean(shift_y)
@@ -404,31 +691,59 @@ class SliceDataset:
         
         return self
     
-    def correct_top_bottom_bg(self):
+    """
+    Background correction. By default, the smoothed mean profiles of TOPBG and BOTBG are
+    interpolated linearly in y between the two regions.
+    With surface_degree=n, a 2D polynomial of degree n is instead fitted (least squares) to all
+    pixels outside of the mask, which requires gen_mask() to have been called.
+    As before, img_bg holds the background with a negative sign and is subtracted from img_data_avg.
+    """
+    def correct_top_bottom_bg(self, smoothing=BG_SMOOTHING_SIGMA, surface_degree=None):
+        if surface_degree is None:
+            bg = self.top_bottom_bg( smoothing )
+        else:
+            bg = self.surface_bg( surface_degree )
+        
+        self.img_bg = -bg
+        self.img_data_avg -= self.img_bg
+        
+        return self
+    
+    def top_bottom_bg(self, smoothing=BG_SMOOTHING_SIGMA):
+        from scipy import ndimage
+        
         bg_upper = np.mean(self.TOPBG(self.img_data_avg), axis=0 )
         bg_lower = np.mean(self.BOTBG(self.img_data_avg), axis=0 )
         
-        bgdev_upper = np.std(self.TOPBG(self.img_data_avg), axis=0 )
-        bgdev_lower = np.std(self.BOTBG(self.img_data_avg), axis=0 )
-        
         idx_upper = self.TOPBG.ymid()
         idx_lower = self.BOTBG.ymid()
         
-        # Smoothe the bg profiles a fair bit
-        kernel = np.array( [ np.exp( -(x**2)/256 ) for x in np.arange(-16,17) ] )
-        kernel /= np.sum(kernel)
-        bg_upper = np.convolve( bg_upper, kernel, mode='same' )
-        bg_lower = np.convolve( bg_lower, kernel, mode='same' )
-        
-        self.img_bg = np.zeros( self.img_data_avg.shape )
-
-        for y in range(self.img_bg.shape[0]):
-            fac = (y-idx_upper)/(idx_lower-idx_upper)
-            self.img_bg[y] -= (fac)*bg_lower + (1-fac)*bg_upper
-        
-        self.img_data_avg -= self.img_bg
-        
-        return self
+        # Smoothe the bg profiles a fair bit (zero outside of the image, like np.convolve(..., mode='same'))
+        if smoothing > 0:
+            radius = int( round( np.sqrt(2)*smoothing ) )
+            bg_upper = ndimage.gaussian_filter1d( bg_upper, smoothing, mode='constant', cval=0.0, radius=radius )
+            bg_lower = ndimage.gaussian_filter1d( bg_lower, smoothing, mode='constant', cval=0.0, radius=radius )
+        
+        # linear interpolation in y, as an outer product
+        fac = ( np.arange( self.img_data_avg.shape[0] )-idx_upper )/( idx_lower-idx_upper )
+        return bg_upper[None,:] + fac[:,None]*( bg_lower-bg_upper )[None,:]
+    
+    def surface_bg(self, degree=2):
+        height, width = self.img_data_avg.shape
+        # coordinates scaled to [-1,1] to keep the fit well-conditioned
+        y = np.linspace( -1.0, 1.0, height )
+        x = np.linspace( -1.0, 1.0, width )
+        powers = [ (i, j) for i in range( degree+1 ) for j in range( degree+1-i ) ]
+        
+        Y, X = np.nonzero( self.img_mask == 0 )
+        A = np.stack( [ np.power( y[Y], i )*np.power( x[X], j ) for i, j in powers ], axis=1 )
+        # normal equations, the system only has as many unknowns as there are powers
+        coefficients = np.linalg.solve( A.T @ A, A.T @ self.img_data_avg[Y,X] )
+        
+        bg = np.zeros( (height, width) )
+        for c, (i, j) in zip( coefficients, powers ):
+            bg += c*np.outer( np.power( y, i ), np.power( x, j ) )
+        return bg
     
     def get_local_spec(self, y, binning=1):
         
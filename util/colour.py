@@ -1,15 +1,47 @@
 # colour_system.py
 import numpy as np
 
-import scipy
-from scipy import interpolate
+# scipy.interpolate is only imported when the CMF data is loaded, see load_cmf
 
 
 # The CIE colour matching function for 380 - 780 nm in 5 nm intervals
-cmf_raw = np.loadtxt('data/cie-cmf.txt', usecols=(0,1,2,3))
-# Interpolate that shit because that's how we roll
-cmf = [ scipy.interpolate.interp1d( cmf_raw[:,0], cmf_raw[:,i], kind=1 ) for i in [1,2,3] ]
-del cmf_raw
+cmf_path = 'data/cie-cmf.txt'
+cmf_interpolants = None
+
+def load_cmf():
+    """Return the colour matching functions as interpolants, reading the
+    data file when they are first needed."""
+
+    global cmf_interpolants
+    if cmf_interpolants is None:
+        import scipy.interpolate
+        cmf_raw = np.loadtxt(cmf_path, usecols=(0,1,2,3))
+        # Interpolate that shit because that's how we roll
+        cmf_interpolants = [ scipy.interpolate.interp1d( cmf_raw[:,0], cmf_raw[:,i], kind=1 ) for i in [1,2,3] ]
+    return cmf_interpolants
+
+def __getattr__(name):
+    # colour.cmf still works, but only loads the data on access
+    if name == 'cmf':
+        return load_cmf()
+    raise AttributeError("module 'util.colour' has no attribute '{}'".format(name))
+
+# The CMFs sampled on the wavelength grids spectra have been converted on,
+# { lda.tobytes() : array of shape (len(lda), 3) }
+cmf_weight_cache = {}
+CMF_WEIGHT_CACHE_SIZE = 16
+
+def cmf_weights(lda):
+    """Return the colour matching functions at the wavelengths lda as an
+    array of shape (len(lda), 3), cached per wavelength grid."""
+
+    lda = np.ascontiguousarray(lda, dtype=np.float64)
+    key = lda.tobytes()
+    if key not in cmf_weight_cache:
+        if len(cmf_weight_cache) >= CMF_WEIGHT_CACHE_SIZE:
+            cmf_weight_cache.clear()
+        cmf_weight_cache[key] = np.stack([ xyz(lda) for xyz in load_cmf() ], axis=-1)
+    return cmf_weight_cache[key]
 
 def xyz_from_xy(x, y):
     """Return the vector (x, y, 1-x-y)."""
@@ -71,12 +103,40 @@ class ColourSystem:
             return self.rgb_to_hex(rgb)
         return rgb
 
+    def xyzs_to_rgb(self, xyz, out_fmt=None):
+        """Transform an array of shape (N, 3) of xyz points to rgb.
+
+        Same as xyz_to_rgb, applied to every row at once. With
+        out_fmt='html', a list of N hex strings is returned.
+
+        """
+
+        rgb = xyz.dot(self.T.T)
+        # desaturate the points outside of the gamut
+        w = np.maximum(-np.min(rgb, axis=1), 0)
+        rgb += w[:, np.newaxis]
+        # normalize every rgb vector on its maximum
+        m = np.max(rgb, axis=1)
+        nonzero = np.any(rgb != 0, axis=1)
+        rgb[nonzero] /= m[nonzero, np.newaxis]
+
+        if out_fmt == 'html':
+            return self.rgbs_to_hex(rgb)
+        return rgb
+
     def rgb_to_hex(self, rgb):
         """Convert from fractional rgb values to HTML-style hex string."""
 
         hex_rgb = (255 * rgb).astype(int)
         return '#{:02x}{:02x}{:02x}'.format(*hex_rgb)
 
+    def rgbs_to_hex(self, rgb):
+        """Convert an array of shape (N, 3) of fractional rgb values to a
+        list of HTML-style hex strings."""
+
+        hex_rgb = (255 * rgb).astype(int)
+        return [ '#{:02x}{:02x}{:02x}'.format(*h) for h in hex_rgb ]
+
     def spec_to_xyz(self, lda, spec):
         """Convert a spectrum to an xyz point.
 
@@ -86,12 +146,24 @@ class ColourSystem:
         """
 
         #XYZ = np.sum(spec[:, np.newaxis] * self.cmf, axis=0)
-        XYZ = np.array( [ np.sum( spec*xyz(lda) ) for xyz in cmf ] )
+        XYZ = np.asarray(spec).dot(cmf_weights(lda))
         den = np.sum(XYZ)
         #den = lda.shape[0]
         if den == 0.:
             return XYZ
         return XYZ / den
+
+    def specs_to_xyz(self, lda, specs):
+        """Convert an array of shape (N, len(lda)) of spectra to an array of
+        shape (N, 3) of xyz points, in a single matrix product.
+
+        """
+
+        XYZ = np.atleast_2d(specs).dot(cmf_weights(lda))
+        den = np.sum(XYZ, axis=1)
+        nonzero = (den != 0.)
+        XYZ[nonzero] /= den[nonzero, np.newaxis]
+        return XYZ
         
 
     def spec_to_rgb(self, lda, spec, out_fmt=None):
@@ -100,6 +172,13 @@ class ColourSystem:
         xyz = self.spec_to_xyz(lda, spec)
         return self.xyz_to_rgb(xyz, out_fmt)
 
+    def specs_to_rgb(self, lda, specs, out_fmt=None):
+        """Convert an array of shape (N, len(lda)) of spectra to rgb values
+        (or, with out_fmt='html', to a list of hex strings)."""
+
+        xyz = self.specs_to_xyz(lda, specs)
+        return self.xyzs_to_rgb(xyz, out_fmt)
+
 illuminant_D65 = xyz_from_xy(0.3127, 0.3291)
 cs_hdtv = ColourSystem(red=xyz_from_xy(0.67, 0.33),
                        green=xyz_from_xy(0.21, 0.71),
@@ -4,10 +4,12 @@ import sys
 
 # For math things
 import numpy as np
-from scipy.interpolate import interp1d
+# scipy.interpolate.interp1d is imported in Device.evaluate, it's slow to import
+import io
 
 # for serialization and deserialization
 import pickle
+import json
 
 
 
@@ -16,68 +18,79 @@ class SpectrometerDataSet:
         self.LDA = np.array( [0.0, 1000.0] )
         self.VAL = np.array( [1.0, 1.0] )
         self.normalization = 1.0
+        self.header_text = ""
+        self.separator = ';'
+        self.header_data = None
     
     def load(self, filename, separator=';', normalize=True):
-        file_instance = open(filename, 'r')
-        lines = file_instance.readlines()
-        file_instance.close()
-        
-        nlines = len(lines)
-        LDA = np.zeros( nlines )
-        VAL = np.zeros( nlines )
-        i = 0
-        section = ""
-        
-        for line in lines:
-            if line[:1] == '[':
-                section = line[1:-2]
-                #print( section, file=sys.stderr )
-            else:
-                if section == "SpectrumHeader":
-                    prop = line.split(separator)[0]
-                    if prop == "#Date":
-                        self.date = line.split(separator)[1][:-1]
-                    elif prop == "#Time":
-                        self.time = line.split(separator)[1][:-1]
-                    elif prop == "#InstrModel":
-                        self.instrument_model = line.split(separator)[1][:-1]
-                if section == "Data":
-                    strings = line.split(separator)
-                    LDA[i] = ( strings[0] )
-                    VAL[i] = ( strings[1] )
-                    i += 1
-        
-        self.LDA = LDA[:i]
-        self.VAL = VAL[:i]
+        with open(filename, 'r') as file_instance:
+            text = file_instance.read()
+        
+        # everything before [Data] is header, which is only parsed when it's asked for (see header())
+        begin = text.find("[Data]")
+        if begin < 0:
+            self.header_text = text
+            block = ""
+        else:
+            self.header_text = text[:begin]
+            begin = text.find("\n", begin) + 1
+            end = text.find("\n[", begin-1)
+            block = text[begin:] if end < 0 else text[begin:end]
+        self.separator = separator
+        self.header_data = None
+        
+        if begin > 0 and block.strip():
+            data = np.loadtxt( io.StringIO(block), delimiter=separator, usecols=(0, 1), ndmin=2 )
+        else:
+            data = np.zeros( (0, 2) )
+        self.LDA = data[:,0]
+        self.VAL = data[:,1]
         if normalize:
             self.normalization = np.mean( self.VAL )
             
         return self
     
-    def interpolate(self, lda):
-        i = 0
-        res = np.empty_like( lda )
-        # catch ArrayIndexOutOfBoundsException here (except it's not called that in python)
-        for j in range(len(lda)):
-            try:
-                while lda[j] > self.LDA[i+1]:
-                    i += 1
-                
-                la = self.LDA[i]    
-                lb = self.LDA[i+1]
-                
-                d = (lda[j]-la)/(lb-la) 
-                
-                va = self.VAL[i]
-                vb = self.VAL[i+1]
-                
-                vd = vb-va
-                
-                res[j] = va+d*vd
-            except IndexError:
-                res[j] = 0.0
-            
-        return res
+    # properties from the [SpectrumHeader] section, e.g. { '#Date':'20210729', '#InstrModel':'CCS200', ... }
+    def header(self):
+        if self.header_data is None:
+            self.header_data = {}
+            section = ""
+            for line in self.header_text.splitlines():
+                if line[:1] == '[':
+                    section = line.strip()[1:-1]
+                elif section == "SpectrumHeader":
+                    fields = line.split(self.separator)
+                    if len(fields) > 1:
+                        self.header_data[fields[0]] = fields[1]
+        return self.header_data
+    
+    @property
+    def date(self):
+        return self.header().get("#Date")
+    
+    @property
+    def time(self):
+        return self.header().get("#Time")
+    
+    @property
+    def instrument_model(self):
+        return self.header().get("#InstrModel")
+    
+    # linear interpolation of the spectrum at the wavelengths lda (any shape, e.g. a 2D batch of grids)
+    # wavelengths outside the measured range get the value fill
+    def interpolate(self, lda, fill=0.0):
+        LDA, VAL = self.LDA, self.VAL
+        # digitized spectra aren't necessarily in order
+        if np.any( np.diff(LDA) < 0 ):
+            order = np.argsort( LDA, kind='stable' )
+            LDA, VAL = LDA[order], VAL[order]
+        return np.interp( lda, LDA, VAL, left=fill, right=fill )
+
+
+# loads all spectra in one directory, e.g. the averaged traces of one device
+def load_directory(directory, separator=';', normalize=True):
+    filenames = sorted( fn for fn in os.listdir( directory ) if not fn.startswith('.') )
+    return [ SpectrometerDataSet().load( os.path.join( directory, fn ), separator, normalize=normalize ) for fn in filenames ]
 
 
 class Descriptor:
@@ -123,12 +136,15 @@ class Device:
         self.uid = ""
         
         self.id_data = Descriptor(**descr).to_dict()
-        self.spec_val = interp1d( np.array([0.0, 500.0, 1000.0]),
-                                  np.array([1.0, 1.0, 1.0]),
-                                  kind=2 )
-        self.spec_err = interp1d( np.array([0.0, 500.0, 1000.0]),
-                                  np.array([0.0, 1.0, 0.0]),
-                                  kind=2 )
+        # the sampled spectrum, this is what gets stored (see export)
+        self.LDA = np.array([0.0, 500.0, 1000.0])
+        self.VAL = np.array([1.0, 1.0, 1.0])
+        self.ERR = np.array([0.0, 1.0, 0.0])
+        # interpolants of the above, built when they are first needed (see evaluate)
+        self.spec_val = None
+        self.spec_err = None
+        # incremented whenever the samples change, so compiled correction tables can tell
+        self.version = 0
         self.ldamin = 500.0
         self.ldamax = 700.0
         
@@ -143,7 +159,19 @@ class Device:
                 self.uid = descr[attrib]
 
     
+    def set_samples(self, LDA, VAL, ERR):
+        self.LDA = np.asarray( LDA, dtype=np.float64 )
+        self.VAL = np.asarray( VAL, dtype=np.float64 )
+        self.ERR = np.asarray( ERR, dtype=np.float64 )
+        self.spec_val = None
+        self.spec_err = None
+        self.version = getattr( self, 'version', 0 ) + 1
+    
     def evaluate(self, LDA):
+        if self.spec_val is None:
+            from scipy.interpolate import interp1d
+            self.spec_val = interp1d( self.LDA, self.VAL, kind=2 )
+            self.spec_err = interp1d( self.LDA, self.ERR, kind=2 )
         return self.spec_val(LDA), self.spec_err(LDA)
     
     def ingest_spectrometer_data(self, datasets, normalize=True):
@@ -164,8 +192,7 @@ class Device:
             val /= norm
             err /= norm
         
-        self.spec_val = interp1d( lda, val, kind=2 )
-        self.spec_err = interp1d( lda, err, kind=2 )
+        self.set_samples( lda, val, err )
         
     def descr_str(self):
         return "{f}: {v} {n}".format( f=self.function, v=self.vendor, n=self.name )
@@ -181,48 +208,136 @@ class Device:
 
 persistent_data_path = "persistent/devices/"
 
-def export(dev):
-    filename = "{d}/{u}.pickle".format( d=persistent_data_path, u=dev.uid )
-    with open( filename, 'wb' ) as exportfile:
-        exportfile.write( pickle.dumps(dev) )
+"""
+All devices are stored in one registry: a JSON index with the description of every device
+and an .npz archive with the sampled spectra ( "<uid>/lda", "<uid>/val" and "<uid>/err" ).
+Loading it doesn't need to construct any interpolants, these are only built on evaluation.
+"""
+registry_index_name = "registry.json"
+registry_data_name = "registry.npz"
+
+# { directory : ( (index mtime, data mtime), index, { name : array } ) }
+registry_cache = {}
+
+def registry_files(directory=None):
+    if directory is None:
+        directory = persistent_data_path
+    return os.path.join( directory, registry_index_name ), os.path.join( directory, registry_data_name )
 
+def device_to_entry(dev):
+    entry = { 'name':dev.name, 'vendor':dev.vendor, 'function':dev.function, 'uid':dev.uid,
+              'id_data':dev.id_data, 'ldamin':float(dev.ldamin), 'ldamax':float(dev.ldamax) }
+    arrays = { "{u}/lda".format(u=dev.uid):dev.LDA, "{u}/val".format(u=dev.uid):dev.VAL, "{u}/err".format(u=dev.uid):dev.ERR }
+    return entry, arrays
+
+def device_from_entry(entry, arrays):
+    dev = Device( name=entry['name'], vendor=entry['vendor'], function=entry['function'], uid=entry['uid'] )
+    dev.id_data = dict( entry['id_data'] )
+    dev.set_limits( entry['ldamin'], entry['ldamax'] )
+    uid = entry['uid']
+    # copies, so the device never shares its samples with anything else
+    dev.set_samples( np.array( arrays["{u}/lda".format(u=uid)] ), np.array( arrays["{u}/val".format(u=uid)] ), np.array( arrays["{u}/err".format(u=uid)] ) )
+    return dev
+
+def write_registry(devices, directory=None):
+    index_file, data_file = registry_files( directory )
+    index = []
+    data = {}
+    for uid in sorted( devices ):
+        entry, arrays = device_to_entry( devices[uid] )
+        index.append( entry )
+        data.update( arrays )
+    
+    # write to temporary files first, so there's never a half-written registry
+    with open( data_file + ".tmp", 'wb' ) as exportfile:
+        np.savez( exportfile, **data )
+    with open( index_file + ".tmp", 'w' ) as exportfile:
+        json.dump( index, exportfile, indent=2 )
+    os.replace( data_file + ".tmp", data_file )
+    os.replace( index_file + ".tmp", index_file )
+
+# the index and all arrays of the registry, as read from disk
+def read_registry_data(directory=None):
+    index_file, data_file = registry_files( directory )
+    with open( index_file, 'r' ) as inputfile:
+        index = json.load( inputfile )
+    with np.load( data_file ) as npz:
+        arrays = { name:npz[name] for name in npz.files }
+    return index, arrays
+
+def read_registry(directory=None):
+    index, arrays = read_registry_data( directory )
+    return { entry['uid']:device_from_entry( entry, arrays ) for entry in index }
+
+# devices exported before the registry existed: one pickle per device
 def load(filename):
     with open( filename, 'rb' ) as inputfile:
         dev = pickle.loads( inputfile.read() )
+    # their spectra only exist as interpolants
+    if not hasattr( dev, 'LDA' ):
+        dev.set_samples( dev.spec_val.x, dev.spec_val.y, dev.spec_err.y )
     return dev
 
-"""
-def load_all():
-    filenames = os.listdir( persistent_data_path )
-    devices = [ load( "{d}/{f}".format( d=persistent_data_path, f=fn ) ) for fn in filenames ]
-    return devices
-"""
-
-def load_all():
-    filenames = os.listdir( persistent_data_path )
+def migrate_pickles(directory=None):
+    if directory is None:
+        directory = persistent_data_path
     devices = {}
-    for fn in filenames:
-        dev = load( "{d}/{f}".format( d=persistent_data_path, f=fn ) )
-        devices[dev.uid] = dev
+    for fn in sorted( os.listdir( directory ) ):
+        if fn.endswith(".pickle"):
+            dev = load( os.path.join( directory, fn ) )
+            devices[dev.uid] = dev
+    write_registry( devices, directory )
     return devices
 
+def export(dev, directory=None):
+    devices = load_all( directory )
+    devices[dev.uid] = dev
+    write_registry( devices, directory )
 
-class Correction:
-    def __init__(self):
-        self.devices = []
-        self.ldamin = 0.0
-        self.ldamax = 1500.0
+# all devices as { uid : Device }, new objects on every call;
+# the registry is only read again from disk once it has changed
+def load_all(directory=None):
+    if directory is None:
+        directory = persistent_data_path
+    index_file, data_file = registry_files( directory )
+    if not ( os.path.exists( index_file ) and os.path.exists( data_file ) ):
+        # no registry yet: only written here if there are old pickles to migrate
+        if not ( os.path.isdir( directory ) and any( fn.endswith(".pickle") for fn in os.listdir( directory ) ) ):
+            return {}
+        migrate_pickles( directory )
     
-    def add_device(self, dev):
-        self.ldamin = np.maximum( self.ldamin, dev.ldamin )
-        self.ldamax = np.minimum( self.ldamax, dev.ldamax )
-        self.devices.append( dev )
-    
-    def evaluate(self, LDA):
+    mtimes = ( os.stat( index_file ).st_mtime_ns, os.stat( data_file ).st_mtime_ns )
+    cached = registry_cache.get( directory )
+    if cached is None or cached[0] != mtimes:
+        cached = ( mtimes, ) + read_registry_data( directory )
+        registry_cache[directory] = cached
+    index, arrays = cached[1], cached[2]
+    return { entry['uid']:device_from_entry( entry, arrays ) for entry in index }
+
+
+# sample spacing (in nm) of the compiled correction tables
+CORRECTION_TABLE_STEP = 0.01
+
+# compiled correction tables, shared by all corrections with the same devices on the same grid
+# { ( ((uid, version), ...), ldamin, ldamax, step ) : ( [device, ...], CorrectionTable ) }
+# (only the most recently used CORRECTION_TABLES_KEPT are kept)
+correction_tables = {}
+CORRECTION_TABLES_KEPT = 8
+
+# product of the device spectra (and its error) sampled on a uniform grid;
+# evaluate() is a linear interpolation on that grid
+class CorrectionTable:
+    def __init__(self, devices, ldamin, ldamax, step=CORRECTION_TABLE_STEP):
+        samples = int( np.ceil( (ldamax-ldamin)/step ) ) + 1
+        self.LDA = np.linspace( ldamin, ldamax, num=samples, endpoint=True )
+        self.ldamin = ldamin
+        self.ldamax = ldamax
+        self.step = (ldamax-ldamin)/(samples-1) if samples > 1 else 1.0
+        
         vals = []
         errs = []
-        for dev in self.devices:
-            val, err = dev.evaluate( LDA )
+        for dev in devices:
+            val, err = dev.evaluate( self.LDA )
             vals.append( val )
             errs.append( err )
         
@@ -235,5 +350,57 @@ class Correction:
         errs *= val
         err = np.sum(errs, axis=0)
         
-        return val, err
+        self.val = val
+        self.err = err
+    
+    def evaluate(self, LDA):
+        LDA = np.asarray( LDA, dtype=np.float64 )
+        if np.any( LDA < self.ldamin ) or np.any( LDA > self.ldamax ):
+            raise ValueError( "wavelengths outside of the correction range [{a}, {b}]".format( a=self.ldamin, b=self.ldamax ) )
         
+        pos = (LDA-self.ldamin)/self.step
+        idx = np.clip( pos.astype(np.intp), 0, max( self.LDA.shape[0]-2, 0 ) )
+        if self.LDA.shape[0] < 2:
+            return self.val[idx], self.err[idx]
+        d = pos-idx
+        val = (1.0-d)*self.val[idx] + d*self.val[idx+1]
+        err = (1.0-d)*self.err[idx] + d*self.err[idx+1]
+        return val, err
+
+class Correction:
+    def __init__(self):
+        self.devices = []
+        self.ldamin = 0.0
+        self.ldamax = 1500.0
+        self.table = None
+        self.table_key = None
+    
+    def add_device(self, dev):
+        self.ldamin = np.maximum( self.ldamin, dev.ldamin )
+        self.ldamax = np.minimum( self.ldamax, dev.ldamax )
+        self.devices.append( dev )
+        self.table = None
+        self.table_key = None
+    
+    # look up (or build) the table for the current devices; rebuilt when their samples have changed
+    def compile(self, step=CORRECTION_TABLE_STEP):
+        devices = sorted( self.devices, key=lambda dev: dev.uid )
+        key = ( tuple( (dev.uid, dev.version) for dev in devices ), float(self.ldamin), float(self.ldamax), step )
+        if self.table is None or self.table_key != key:
+            entry = correction_tables.pop( key, None )
+            # a device with the same uid may have been ingested again in the meantime
+            if entry is None or len(entry[0]) != len(devices) or any( a is not b for a, b in zip( entry[0], devices ) ):
+                entry = ( devices, CorrectionTable( devices, self.ldamin, self.ldamax, step ) )
+            # (re-)inserted as the most recently used one
+            correction_tables[key] = entry
+            while len( correction_tables ) > CORRECTION_TABLES_KEPT:
+                del correction_tables[ next( iter( correction_tables ) ) ]
+            self.table = entry[1]
+            self.table_key = key
+        return self.table
+    
+    def evaluate(self, LDA):
+        if not self.devices:
+            LDA = np.asarray( LDA, dtype=np.float64 )
+            return np.ones_like( LDA ), np.zeros_like( LDA )
+        return self.compile().evaluate( LDA )
@@ -0,0 +1,143 @@
+
+import os
+import json
+
+import numpy as np
+
+from util import mie_theory
+
+
+
+"""
+Precomputed Mie scattering spectra for spheres of different materials, diameters and media.
+
+The spectra are normalized (unit RMS over the library's wavelengths) and stored as one float32
+array of shape ( materials, diameters, media, wavelengths ) in spectra.npy, which is opened as a
+memory map. The RMS values (in µm²) and the grid are kept in norms.npy and index.json.
+Measured spectra are matched with a least-squares scan over all entries, with a free scale factor,
+so they don't need to be normalized (or even corrected for a constant factor) beforehand.
+
+    lib = mie_library.TheoryLibrary().build()   # once, takes a few seconds
+    lib.save()
+    ...
+    lib = mie_library.TheoryLibrary().load()
+    material, d, n1, scale, residual = lib.fit( LDA, spectrum )
+"""
+
+library_path = "persistent/theory/"
+
+# defaults for build()
+LIBRARY_MATERIALS = [ "Au", "Ag" ]
+LIBRARY_DIAMETERS = np.arange( 10, 202, 2 )*1e-9
+LIBRARY_MEDIA = np.round( np.arange( 1.30, 1.605, 0.01 ), 2 )
+LIBRARY_LDA = np.linspace( 400, 800, 201 )*1e-9
+
+# number of library entries compared at once in fit()
+FIT_CHUNK_ENTRIES = 4096
+
+
+class TheoryLibrary:
+    def __init__(self):
+        self.materials = []
+        self.diameters = np.zeros( 0 )
+        self.media = np.zeros( 0 )
+        self.LDA = np.zeros( 0 )
+        self.spectra = np.zeros( (0, 0, 0, 0), dtype=np.float32 )
+        self.norms = np.zeros( (0, 0, 0), dtype=np.float32 )
+    
+    def build(self, materials=LIBRARY_MATERIALS, diameters=LIBRARY_DIAMETERS, media=LIBRARY_MEDIA, lda=LIBRARY_LDA, workers=None):
+        self.materials = list( materials )
+        self.diameters = np.asarray( diameters, dtype=np.float64 )
+        self.media = np.asarray( media, dtype=np.float64 )
+        self.LDA = np.asarray( lda, dtype=np.float64 )
+        
+        spectra = np.empty( ( len(self.materials), len(self.diameters), len(self.media), len(self.LDA) ), dtype=np.float32 )
+        norms = np.empty( spectra.shape[:-1], dtype=np.float32 )
+        for i, material in enumerate( self.materials ):
+            sigma = mie_theory.sigma_grid( self.LDA, 0.5*self.diameters, self.media, material, workers=workers )*1e12 # µm²
+            norm = np.sqrt( np.mean( np.square( sigma ), axis=-1 ) )
+            spectra[i] = sigma/norm[...,None]
+            norms[i] = norm
+        self.spectra = spectra
+        self.norms = norms
+        return self
+    
+    def save(self, directory=library_path):
+        os.makedirs( directory, exist_ok=True )
+        np.save( os.path.join( directory, "spectra.npy" ), self.spectra )
+        np.save( os.path.join( directory, "norms.npy" ), self.norms )
+        index = { 'materials':self.materials, 'diameters':self.diameters.tolist(), 'media':self.media.tolist(), 'lda':self.LDA.tolist() }
+        with open( os.path.join( directory, "index.json" ), 'w' ) as exportfile:
+            json.dump( index, exportfile, indent=2 )
+        return self
+    
+    def load(self, directory=library_path):
+        with open( os.path.join( directory, "index.json" ), 'r' ) as inputfile:
+            index = json.load( inputfile )
+        self.materials = index['materials']
+        self.diameters = np.array( index['diameters'] )
+        self.media = np.array( index['media'] )
+        self.LDA = np.array( index['lda'] )
+        self.spectra = np.load( os.path.join( directory, "spectra.npy" ), mmap_mode='r' )
+        self.norms = np.load( os.path.join( directory, "norms.npy" ), mmap_mode='r' )
+        return self
+    
+    # indices of the library entry closest to the given parameters
+    def nearest(self, material, d, n1):
+        return ( self.materials.index( material ),
+                 int( np.argmin( np.abs( self.diameters - d ) ) ),
+                 int( np.argmin( np.abs( self.media - n1 ) ) ) )
+    
+    # scattering cross section (µm²) of the closest library entry
+    def spectrum(self, material, d, n1):
+        i, j, k = self.nearest( material, d, n1 )
+        return self.spectra[i,j,k]*self.norms[i,j,k]
+    
+    # least-squares fit of measured spectra (shape (wavelengths,) or (spectra, wavelengths)) at the
+    # wavelengths LDA; only the overlap with the library's wavelengths is used.
+    # Returns material, diameter, medium index, scale factor (relative to the normalized library spectrum)
+    # and residual of the best entry (per spectrum)
+    def fit(self, LDA, spectra):
+        LDA = np.asarray( LDA, dtype=np.float64 )
+        spectra = np.asarray( spectra, dtype=np.float64 )
+        single = ( spectra.ndim == 1 )
+        spectra = np.atleast_2d( spectra )
+        
+        # measured spectra resampled to the library's wavelengths
+        order = np.argsort( LDA )
+        mask = ( self.LDA >= LDA[order[0]] ) & ( self.LDA <= LDA[order[-1]] )
+        if np.sum( mask ) < 2:
+            raise ValueError( "wavelengths [{a}, {b}] don't overlap the library's wavelengths [{c}, {d}] (in m)".format( a=LDA[order[0]], b=LDA[order[-1]], c=self.LDA[0], d=self.LDA[-1] ) )
+        S = np.array( [ np.interp( self.LDA[mask], LDA[order], spectrum[order] ) for spectrum in spectra ] )
+        ss = np.sum( np.square( S ), axis=1 )
+        
+        # residual of the best scale c = <s,t>/<t,t>: |s|² - <s,t>²/<t,t>, scanned in chunks of entries
+        T = self.spectra.reshape( -1, len(self.LDA) )
+        best = np.zeros( len(S), dtype=int )
+        best_res = np.full( len(S), np.inf )
+        best_scale = np.zeros( len(S) )
+        for begin in range( 0, T.shape[0], FIT_CHUNK_ENTRIES ):
+            chunk = np.asarray( T[begin:begin+FIT_CHUNK_ENTRIES][:,mask], dtype=np.float64 )
+            tt = np.sum( np.square( chunk ), axis=1 )
+            st = S @ chunk.T
+            # entries that vanish at these wavelengths can't be scaled to fit
+            valid = ( tt > 0 )
+            tt = np.where( valid, tt, 1.0 )
+            res = np.where( valid, ss[:,None] - np.square( st )/tt, np.inf )
+            idx = np.argmin( res, axis=1 )
+            rows = np.arange( len(S) )
+            improved = res[rows,idx] < best_res
+            best[improved] = begin + idx[improved]
+            best_res[improved] = res[rows,idx][improved]
+            best_scale[improved] = ( st[rows,idx]/tt[idx] )[improved]
+        
+        if not np.all( np.isfinite( best_res ) ):
+            raise ValueError( "no library entry is nonzero at the measured wavelengths" )
+        
+        i, j, k = np.unravel_index( best, self.spectra.shape[:-1] )
+        material = np.array( self.materials )[i]
+        diameter = self.diameters[j]
+        medium = self.media[k]
+        if single:
+            return material[0], diameter[0], medium[0], best_scale[0], best_res[0]
+        return material, diameter, medium, best_scale, best_res
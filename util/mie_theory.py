@@ -6,14 +6,13 @@
 import numpy as np
 pi = np.pi
 
-from scipy.interpolate import interp1d
-from matplotlib.ticker import FuncFormatter
+from scipy.interpolate import make_interp_spline
+from concurrent.futures import ProcessPoolExecutor
 
 
 # FUNCTION DEFINITIONS
 
 from scipy.special import jv, yv, lpmv
-from scipy.misc import derivative
 
 def j(x, n): 
     return np.sqrt(pi/(2*x))*jv(n+1/2, x)
@@ -44,29 +43,198 @@ def a(x, n, m):
 def b(x, n, m):
     return (psi(m*x, n)*d_psi(x, n) - m*psi(x, n)*d_psi(m*x, n))/(psi(m*x, n)*d_xi(x, n) - m*xi(x, n)*d_psi(m*x, n))
 
-def x(lda, r, n1):
-    return 2*pi*r*n1/lda
-
-def m(lda, n1, n2):
-    return n2(lda)/n1
+# MATERIALS
+
+refractive_index_path = "data/refractive-indices/"
+
+"""
+Complex refractive index of a material, read once from <name>_nk.txt (wavelength in µm, n, k).
+Evaluation is a quadratic spline interpolation (like interp1d with kind=2) in the wavelength in m.
+"""
+class Material:
+    def __init__(self, name):
+        self.name = name
+        filename = "{d}/{n}_nk.txt".format( d=refractive_index_path, n=name )
+        lda, n, k = np.transpose( np.loadtxt( filename, skiprows=1 ) )
+        self.LDA = lda*1e-6
+        self.N = n + 1j*k
+        self.spline = make_interp_spline( self.LDA, self.N, k=2 )
+        self.ldamin = self.LDA[0]
+        self.ldamax = self.LDA[-1]
     
-def sigma_sca(lda, r, n1, n2, N):
-    return np.array([(2*pi*r**2)/x(lda, r, n1)**2*(2*n + 1)*(np.abs(a(x(lda, r, n1), n, m(lda, n1, n2)))**2 + np.abs(b(x(lda, r, n1), n, m(lda, n1, n2)))**2) for n in range(1, N+1)]).sum(axis=0)
+    def __call__(self, lda):
+        lda = np.asarray( lda )
+        if np.any( lda < self.ldamin ) or np.any( lda > self.ldamax ):
+            raise ValueError( "wavelengths outside of the data range of {n}".format(n=self.name) )
+        return self.spline( lda )
+
+# { name : Material }, every nk file is only read once
+materials = {}
 
-def sigma_ext(lda, r, n1, n2, N):
-    return np.array([(2*pi*r**2)/x(lda, r, n1)**2*(2*n + 1)*(np.real(a(x(lda, r, n1), n, m(lda, n1, n2)) + b(x(lda, r, n1), n, m(lda, n1, n2)))) for n in range(1, N+1)]).sum(axis=0)
+def material(name):
+    if name not in materials:
+        materials[name] = Material( name )
+    return materials[name]
 
-def sigma_abs(lda, r, n1, n2, N):
-    return sigma_ext(lda, r, n1, n2, N) - sigma_sca(lda, r, n1, n2, N)
+# the refractive index n2 can be given as a material name or as a function of the wavelength
+def refractive_index(n2):
+    if isinstance( n2, str ):
+        return material( n2 )
+    return n2
 
-def g(lda, r, n1, n2, N):
-    return (4*pi*r**2)/(x(lda, r, n1)**2*sigma_sca(lda, r, n1, n2, N))*np.array([n*(n+2)/(n+1)*np.real(a(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(a(x(lda,r, n1), n+1, m(lda, n1, n2))) + b(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(b(x(lda, r, n1), n+1, m(lda, n1, n2)))) + (2*n+1)/(n*(n+1))*np.real(a(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(b(x(lda, r, n1), n, m(lda, n1, n2)))) for n in range(1, N+1)]).sum(axis=0)
 
-def sigma_pr(lda, r, n1, n2, N):
-    return (2*pi*r**2)/x(lda, r, n1)**2*np.array([(2*n+1)/(n*(n+1))*np.real(a(x(lda, r, n1), n, m(lda, n1, n2)) + np.conj(b(x(lda, r, n1), n, m(lda, n1, n2))) - 2*a(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(b(x(lda, r, n1), n, m(lda, n1, n2)))) + n*(n+2)/(n+1)*np.real(a(x(lda, r, n1), n, m(lda, n1, n2)) + b(x(lda, r, n1), n, m(lda, n1, n2)) + np.conj(a(x(lda, r, n1), n+1, m(lda, n1, n2))) + np.conj(b(x(lda, r, n1), n+1, m(lda, n1, n2))) - 2*a(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(a(x(lda, r, n1), n+1, m(lda, n1, n2))) - 2*b(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(b(x(lda, r, n1), n+1, m(lda, n1, n2)))) for n in range(1, N+1)]).sum(axis=0)
+def x(lda, r, n1):
+    return 2*pi*r*n1/lda
 
-def sigma_pr_(lda, r, n1, n2, N):
-    return sigma_ext(lda, r, n1, n2, N) - (4*pi*r**2)/x(lda, r, n1)**2*np.array([n*(n+2)/(n+1)*np.real(a(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(a(x(lda,r, n1), n+1, m(lda, n1, n2))) + b(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(b(x(lda, r, n1), n+1, m(lda, n1, n2)))) + (2*n+1)/(n*(n+1))*np.real(a(x(lda, r, n1), n, m(lda, n1, n2))*np.conj(b(x(lda, r, n1), n, m(lda, n1, n2)))) for n in range(1, N+1)]).sum(axis=0)
+def m(lda, n1, n2):
+    return refractive_index(n2)(lda)/n1
+    
+# number of orders needed for convergence (Wiscombe, Appl. Opt. 19, 1505 (1980))
+def wiscombe_nstop(x):
+    return np.floor( x + 4*np.cbrt(x) + 2 ).astype(int)
+
+# a_n and b_n for the orders n = 1 .. N, as arrays of shape (N,) + x.shape
+# The logarithmic derivative D_n(mx) is computed by downward recurrence, psi_n(x) and xi_n(x)
+# by upward recurrence (as in Bohren & Huffman's BHMIE). Orders beyond the Wiscombe criterion
+# of each x are set to zero (they are negligible, and upward recurrence isn't stable there).
+# Without N, the coefficients are computed up to the largest such order.
+def mie_coefficients(x, m, N=None):
+    x, m = np.broadcast_arrays( np.asarray( x, dtype=np.float64 ), np.asarray( m, dtype=np.complex128 ) )
+    nstop = wiscombe_nstop( x )
+    if N is None:
+        N = int( np.max( nstop, initial=1 ) )
+    nmx = int( max( N, np.max( np.abs( m*x ), initial=0 ) ) ) + 15
+    mx = m*x
+    
+    a = np.zeros( (N,) + x.shape, dtype=np.complex128 )
+    b = np.zeros( (N,) + x.shape, dtype=np.complex128 )
+    with np.errstate( all='ignore' ):
+        # D[n] = D_n(mx), n = 0 .. N
+        D = np.zeros( (N+1,) + x.shape, dtype=np.complex128 )
+        Dn = np.zeros( x.shape, dtype=np.complex128 )
+        for n in range( nmx, 0, -1 ):
+            # D_(n-1) from D_n
+            Dn = n/mx - 1/( Dn + n/mx )
+            if n-1 <= N:
+                D[n-1] = Dn
+        
+        psi0, psi1 = np.cos(x), np.sin(x)
+        chi0, chi1 = -np.sin(x), np.cos(x)
+        xi1 = psi1 - 1j*chi1
+        for n in range( 1, N+1 ):
+            psi = (2*n-1)/x*psi1 - psi0
+            chi = (2*n-1)/x*chi1 - chi0
+            xi = psi - 1j*chi
+            
+            an = ( (D[n]/m + n/x)*psi - psi1 )/( (D[n]/m + n/x)*xi - xi1 )
+            bn = ( (m*D[n] + n/x)*psi - psi1 )/( (m*D[n] + n/x)*xi - xi1 )
+            a[n-1] = np.where( n <= nstop, an, 0.0 )
+            b[n-1] = np.where( n <= nstop, bn, 0.0 )
+            
+            psi0, psi1 = psi1, psi
+            chi0, chi1 = chi1, chi
+            xi1 = psi1 - 1j*chi1
+    return a, b
+
+# size parameter and a_n, b_n (orders 1 .. N+extra) for a sphere of radius r at the wavelengths lda,
+# evaluating the refractive index n2 only once
+def coefficients(lda, r, n1, n2, N=None, extra=0):
+    xx = x(lda, r, n1)
+    if N is None:
+        N = int( np.max( wiscombe_nstop( np.asarray(xx) ), initial=1 ) )
+    a, b = mie_coefficients( xx, m(lda, n1, n2), N+extra )
+    return np.asarray(xx), a, b
+
+# order numbers, shaped to broadcast against coefficients of shape (N,) + x.shape
+def orders(a):
+    return np.arange( 1, a.shape[0]+1 ).reshape( (-1,) + (1,)*(a.ndim-1) )
+
+def sigma_sca(lda, r, n1, n2, N=None):
+    xx, a, b = coefficients(lda, r, n1, n2, N)
+    n = orders(a)
+    return (2*pi*r**2)/xx**2*np.sum( (2*n + 1)*( np.abs(a)**2 + np.abs(b)**2 ), axis=0 )
+
+def sigma_ext(lda, r, n1, n2, N=None):
+    xx, a, b = coefficients(lda, r, n1, n2, N)
+    n = orders(a)
+    return (2*pi*r**2)/xx**2*np.sum( (2*n + 1)*np.real( a + b ), axis=0 )
+
+def sigma_abs(lda, r, n1, n2, N=None):
+    xx, a, b = coefficients(lda, r, n1, n2, N)
+    n = orders(a)
+    return (2*pi*r**2)/xx**2*np.sum( (2*n + 1)*( np.real( a + b ) - np.abs(a)**2 - np.abs(b)**2 ), axis=0 )
+
+# the sum shared by g and sigma_pr_, from coefficients with one extra order
+def asymmetry_sum(a, b):
+    n = orders(a)[:-1]
+    a0, a1 = a[:-1], a[1:]
+    b0, b1 = b[:-1], b[1:]
+    return np.sum( n*(n+2)/(n+1)*np.real( a0*np.conj(a1) + b0*np.conj(b1) ) + (2*n+1)/(n*(n+1))*np.real( a0*np.conj(b0) ), axis=0 )
+
+def g(lda, r, n1, n2, N=None):
+    xx, a, b = coefficients(lda, r, n1, n2, N, extra=1)
+    n = orders(a)[:-1]
+    sca = (2*pi*r**2)/xx**2*np.sum( (2*n + 1)*( np.abs(a[:-1])**2 + np.abs(b[:-1])**2 ), axis=0 )
+    return (4*pi*r**2)/(xx**2*sca)*asymmetry_sum(a, b)
+
+def sigma_pr(lda, r, n1, n2, N=None):
+    xx, a, b = coefficients(lda, r, n1, n2, N, extra=1)
+    n = orders(a)[:-1]
+    a0, a1 = a[:-1], a[1:]
+    b0, b1 = b[:-1], b[1:]
+    return (2*pi*r**2)/xx**2*np.sum( (2*n+1)/(n*(n+1))*np.real( a0 + np.conj(b0) - 2*a0*np.conj(b0) ) + n*(n+2)/(n+1)*np.real( a0 + b0 + np.conj(a1) + np.conj(b1) - 2*a0*np.conj(a1) - 2*b0*np.conj(b1) ), axis=0 )
+
+def sigma_pr_(lda, r, n1, n2, N=None):
+    xx, a, b = coefficients(lda, r, n1, n2, N, extra=1)
+    n = orders(a)[:-1]
+    ext = (2*pi*r**2)/xx**2*np.sum( (2*n + 1)*np.real( a[:-1] + b[:-1] ), axis=0 )
+    return ext - (4*pi*r**2)/xx**2*asymmetry_sum(a, b)
+
+# cross sections over a grid of radii x medium indices x wavelengths
+GRID_CHUNK_ELEMENTS = 2**18
+
+def cross_sections(xx, a, b, r, quantity):
+    n = orders(a)
+    if quantity == 'sca':
+        terms = np.abs(a)**2 + np.abs(b)**2
+    elif quantity == 'ext':
+        terms = np.real( a + b )
+    elif quantity == 'abs':
+        terms = np.real( a + b ) - np.abs(a)**2 - np.abs(b)**2
+    else:
+        raise ValueError( "unknown quantity '{q}'".format(q=quantity) )
+    return (2*pi*r**2)/xx**2*np.sum( (2*n + 1)*terms, axis=0 )
+
+# one chunk of radii, for all media and wavelengths; n2 is already evaluated at lda
+def grid_chunk(lda, radii, media, n2_values, quantity, N):
+    r = radii[:,None,None]
+    n1 = media[None,:,None]
+    xx = 2*pi*r*n1/lda[None,None,:]
+    a, b = mie_coefficients( xx, n2_values[None,None,:]/n1, N )
+    return cross_sections( xx, a, b, r, quantity )
+
+# sigma_sca (or 'ext', 'abs') for every combination of radius, medium index and wavelength,
+# as an array of shape ( len(radii), len(media), len(lda) )
+# The refractive index n2 is evaluated once, the coefficients of all particles are computed
+# together in chunks of radii; with workers > 1, the chunks are spread across processes.
+def sigma_grid(lda, radii, media, n2, quantity='sca', N=None, workers=None):
+    lda = np.atleast_1d( np.asarray( lda, dtype=np.float64 ) )
+    radii = np.atleast_1d( np.asarray( radii, dtype=np.float64 ) )
+    media = np.atleast_1d( np.asarray( media, dtype=np.float64 ) )
+    n2_values = np.asarray( refractive_index(n2)(lda), dtype=np.complex128 )
+    
+    step = max( 1, GRID_CHUNK_ELEMENTS//( len(media)*len(lda) ) )
+    if workers is not None and workers > 1:
+        step = min( step, max( 1, int( np.ceil( len(radii)/workers ) ) ) )
+    chunks = [ radii[i:i+step] for i in range( 0, len(radii), step ) ]
+    
+    if workers is None or workers <= 1 or len(chunks) < 2:
+        results = [ grid_chunk( lda, chunk, media, n2_values, quantity, N ) for chunk in chunks ]
+    else:
+        with ProcessPoolExecutor( max_workers=workers ) as executor:
+            futures = [ executor.submit( grid_chunk, lda, chunk, media, n2_values, quantity, N ) for chunk in chunks ]
+            results = [ future.result() for future in futures ]
+    return np.concatenate( results, axis=0 )
 
 def P_mn(x, m, n):
     return lpmv(m, n, np.cos(x))
@@ -78,24 +246,36 @@ def tau_mn(x, m, n):
     #return derivative(P_mn, x, dx=1e-6, args=(m, n, ))
     return -(1 + n)*1/np.tan(x)*P_mn(x, m, n) + (1 - m + n)*1/np.sin(x)*P_mn(x, m, n + 1)
 
-def S1(theta, lda, r, n1, n2, N):
-    return np.array([(2*n+1)/(n*(n+1))*(a(x(lda, r, n1), n, m(lda, n1, n2))*pi_mn(theta, 1, n) + b(x(lda, r, n1), n, m(lda, n1, n2))*tau_mn(theta, 1, n)) for n in range(1, N+1)]).sum(axis=0)
-
-def S2(theta, lda, r, n1, n2, N):
-    return np.array([(2*n+1)/(n*(n+1))*(a(x(lda, r, n1), n, m(lda, n1, n2))*tau_mn(theta, 1, n) + b(x(lda, r, n1), n, m(lda, n1, n2))*pi_mn(theta, 1, n)) for n in range(1, N+1)]).sum(axis=0)
-
-
-def THEORY_CURVE( LDA, d=100e-6, n1=1.33 ):
-    # DIELECTRIC FUNCTION OF SPHERE MATERIAL
-
-    lda, n, k = np.transpose(np.loadtxt('data/refractive-indices/Au_nk.txt', skiprows=1)) # load experimental data for refractive index and extinction coefficient vs wavelength
-    n2 = interp1d(lda*1e-6, n + 1j*k, kind=2) # interpolate data
-
+# angular functions pi_n and tau_n for the orders 1 .. N, shape (N,) + theta.shape
+def angular_functions(theta, N):
+    pis = np.array( [ pi_mn(theta, 1, n) for n in range(1, N+1) ] )
+    taus = np.array( [ tau_mn(theta, 1, n) for n in range(1, N+1) ] )
+    return pis, taus
+
+# coefficients of shape (N,) + shape, padded to ndim dimensions so that shape broadcasts
+# against other per-order arrays like it would without the order axis
+def pad_orders(a, ndim):
+    return a.reshape( a.shape[:1] + (1,)*(ndim-a.ndim) + a.shape[1:] )
+
+# theta broadcasts against lda, the same way as in the sum over orders
+def S1(theta, lda, r, n1, n2, N=None):
+    xx, a, b = coefficients(lda, r, n1, n2, N)
+    pis, taus = angular_functions( theta, a.shape[0] )
+    ndim = max( a.ndim, pis.ndim )
+    a, b, pis, taus = [ pad_orders( arr, ndim ) for arr in [ a, b, pis, taus ] ]
+    n = orders( a*pis )
+    return np.sum( (2*n+1)/(n*(n+1))*( a*pis + b*taus ), axis=0 )
+
+def S2(theta, lda, r, n1, n2, N=None):
+    xx, a, b = coefficients(lda, r, n1, n2, N)
+    pis, taus = angular_functions( theta, a.shape[0] )
+    ndim = max( a.ndim, pis.ndim )
+    a, b, pis, taus = [ pad_orders( arr, ndim ) for arr in [ a, b, pis, taus ] ]
+    n = orders( a*pis )
+    return np.sum( (2*n+1)/(n*(n+1))*( a*taus + b*pis ), axis=0 )
+
+
+def THEORY_CURVE( LDA, d=100e-6, n1=1.33, n2="Au" ):
+    # DIELECTRIC FUNCTION OF SPHERE MATERIAL: a material name (see Material) or a function of the wavelength
     #lda = np.linspace(400, 800, 100)*1e-9
-    return sigma_sca( LDA, 0.5*d, n1, n2, 100 )*1e12 #µm²
-    
-    
-
-
-
-
+    return sigma_sca( LDA, 0.5*d, n1, n2 )*1e12 #µm²
@@ -201,13 +201,11 @@ class Object:
         self.MAX_LDA = MAX_LDA
         X, Y, self.LDA = self.gen_roi_coords(self.MAX_LDA)
         
-        roi_data = np.zeros( ( self.video.frames, X.shape[0], X.shape[1] ) )
-        for F in range( self.video.frames ):
-            roi_data[ F, :, : ] = self.video.interpolate( F, Y, X, k )
+        # all frames in one go (same result as a RectBivariateSpline of degree k fitted to each full frame)
+        roi_data = self.video.resample( Y, X, k )
         #for xi in range( X.shape[0] ):
         #    for yi in range( X.shape[1] ):
         #        roi_data[ : , xi, yi] = self.video.interpolateXY( X[xi, yi], Y[xi, yi] )
-        # TODO: optimize
         
         #return roi_data, LDA
         self.ROI = roi_data
@@ -1,7 +1,8 @@
 
 # For math things
 import numpy as np
-from scipy import interpolate
+# scipy (interpolate, linalg, sparse) is imported in the functions that resample video data,
+# so that just loading videos doesn't pay for importing it
 # used once in interpolation
 # TODO: maybe find the numpy equivalent to improve performace
 import math
@@ -15,6 +16,10 @@ from os import path
 
 import warnings
 
+# For loading several files at once
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+
 
 
 
@@ -118,6 +123,201 @@ def files_to_descriptors(files):
     #return [ Descriptor().from_dict( d ) for d in res ]
 
 
+
+# number of frames decoded at once when iterating over a (lazily loaded) video
+CHUNK_FRAMES = 64
+
+"""
+Base class for frame-indexable views onto video data that is not held in memory.
+Indexing works like it would on a (frames, rows, columns) numpy array, i.e.
+  data[F], data[a:b], data[:, y, x], data[[1,5,9]]
+but only the frames that are actually touched are read and decoded.
+Subclasses need to set self.shape and implement read(begin, end).
+"""
+class LazyFrames:
+    def __init__(self):
+        self.shape = (0, 0, 0)
+        self.dtype = np.dtype( np.float64 )
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    # contiguous block of frames [begin, end) as an array of shape (end-begin, rows, columns)
+    def read(self, begin, end):
+        return np.zeros( (0, self.shape[1], self.shape[2]), dtype=self.dtype )
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        fkey, rest = key[0], key[1:]
+        frames = self.shape[0]
+
+        if isinstance(fkey, (int, np.integer)):
+            f = int(fkey)
+            if f < 0:
+                f += frames
+            if not 0 <= f < frames:
+                raise IndexError("frame {f} is out of range for {n} frames".format(f=fkey, n=frames))
+            return self.read( f, f+1 )[0][rest]
+
+        if isinstance(fkey, slice):
+            r = range( *fkey.indices(frames) )
+            if len(r) == 0:
+                block = self.read( 0, 0 )
+            else:
+                # read the covered block of frames in one go, then pick every step-th
+                lo = min( r[0], r[-1] )
+                hi = max( r[0], r[-1] ) + 1
+                block = self.read( lo, hi )[ r[0]-lo :: r.step ]
+            return block[ (slice(None),) + rest ]
+
+        # integer or boolean index arrays
+        idxs = np.arange(frames)[ np.asarray(fkey) ]
+        block = np.empty( (idxs.size, self.shape[1], self.shape[2]), dtype=self.dtype )
+        for i, f in enumerate( idxs.reshape(-1) ):
+            block[i] = self.read( f, f+1 )[0]
+        return block.reshape( idxs.shape + self.shape[1:] )[ (slice(None),)*idxs.ndim + rest ]
+
+    def __array__(self, dtype=None, copy=None):
+        # decodes everything; only meant as a fallback for code that wants a plain array
+        arr = self.read( 0, self.shape[0] )
+        return arr if dtype is None else arr.astype(dtype)
+
+    def chunks(self, chunk_frames=CHUNK_FRAMES):
+        for begin in range(0, self.shape[0], chunk_frames):
+            yield begin, self.read( begin, min(begin+chunk_frames, self.shape[0]) )
+
+    def max_value(self):
+        return max( np.max(chunk) for begin, chunk in self.chunks() )
+
+
+"""
+Image data in a single TDMS file, read through nptdms' streaming reader (TdmsFile.open).
+With dtype=None, frames are normalized to the maximum of the whole file, just like the eagerly
+loaded data; that maximum is found with one chunked pass over the file the first time it is needed.
+Otherwise, frames are the raw camera counts converted to dtype.
+"""
+class TdmsFrames(LazyFrames):
+    def __init__(self, tdms_file, group, channel, shape, dtype=None):
+        super().__init__()
+        self.tdms_file = tdms_file
+        self.channel = tdms_file[group][channel]
+        self.shape = tuple( int(s) for s in shape )
+        self.frame_size = self.shape[1]*self.shape[2]
+        self.peak = None
+        # the streaming reader seeks around in one file handle, so reads from several threads take turns
+        self.lock = threading.Lock()
+        self.normalize = dtype is None
+        if not self.normalize:
+            self.dtype = np.dtype(dtype)
+
+    def read_raw(self, begin, end):
+        with self.lock:
+            raw = self.channel[ begin*self.frame_size : end*self.frame_size ]
+        return raw.reshape( end-begin, self.shape[1], self.shape[2] )
+
+    def max_value(self):
+        if self.peak is None:
+            self.peak = max( np.max( self.read_raw( begin, min(begin+CHUNK_FRAMES, self.shape[0]) ) ) for begin in range(0, self.shape[0], CHUNK_FRAMES) )
+        return self.peak
+
+    def read(self, begin, end):
+        if self.normalize:
+            return self.read_raw( begin, end )/self.max_value()
+        return self.read_raw( begin, end ).astype( self.dtype, copy=False )
+
+    def close(self):
+        self.tdms_file.close()
+
+
+"""
+Several frame sources (arrays or LazyFrames) that are presented as one long video.
+"""
+class ConcatenatedFrames(LazyFrames):
+    def __init__(self, parts):
+        super().__init__()
+        self.parts = list(parts)
+        self.offsets = np.cumsum( [0] + [ len(p) for p in self.parts ] )
+        if self.parts:
+            self.shape = ( int(self.offsets[-1]), ) + tuple( self.parts[0].shape[1:] )
+            self.dtype = np.dtype( self.parts[0].dtype )
+
+    def read(self, begin, end):
+        block = np.empty( (end-begin, self.shape[1], self.shape[2]), dtype=self.dtype )
+        first = int( np.searchsorted( self.offsets, begin, side='right' ) ) - 1
+        for p in range( max(first, 0), len(self.parts) ):
+            a = max( begin, self.offsets[p] )
+            b = min( end, self.offsets[p+1] )
+            if a >= b:
+                break
+            block[ a-begin : b-begin ] = self.parts[p][ a-self.offsets[p] : b-self.offsets[p] ]
+        return block
+
+    def max_value(self):
+        return max( p.max_value() if isinstance(p, LazyFrames) else np.max(p) for p in self.parts )
+
+    def close(self):
+        for p in self.parts:
+            if isinstance(p, TdmsFrames):
+                p.close()
+
+
+# default number of threads used to read several TDMS files at once (None: let concurrent.futures decide);
+# used wherever workers=None is passed
+LOAD_WORKERS = None
+
+"""
+Runs func(item) for all items on a thread pool and yields (index, result) in the order
+in which they finish. Reading and decoding TDMS files is mostly file I/O and numpy
+array operations, which release the GIL, so threads scale with the number of cores
+and can write into slices of one shared output array.
+"""
+def run_concurrently(func, items, workers=None):
+    items = list(items)
+    if workers is None:
+        workers = LOAD_WORKERS
+    if workers == 1 or len(items) < 2:
+        for i, item in enumerate(items):
+            yield i, func(item)
+        return
+    with ThreadPoolExecutor( max_workers=workers ) as pool:
+        futures = { pool.submit( func, item ): i for i, item in enumerate(items) }
+        try:
+            for future in as_completed( futures ):
+                yield futures[future], future.result()
+        finally:
+            # if the caller stops early, don't start the remaining items
+            for future in futures:
+                future.cancel()
+
+# videos for all descriptors, loaded concurrently and returned in order;
+# progress(done, total) is called (in the calling thread) whenever a file has been loaded
+def load_videos(descriptors, lazy=False, dtype=None, workers=None, progress=None):
+    videos = [ None ]*len(descriptors)
+    for done, (i, video) in enumerate( run_concurrently( lambda d: Video().load(d, lazy, dtype), descriptors, workers ) ):
+        videos[i] = video
+        if progress:
+            progress( done+1, len(descriptors) )
+    return videos
+
+
+# dtype=COMPACT keeps the camera counts in the channel's own type if that is an integer type
+# of at most 16 bits, and uses float32 otherwise (so wider counts are never wrapped around)
+COMPACT = "compact"
+
+def compact_dtype(dtype):
+    dtype = np.dtype( dtype )
+    if np.issubdtype( dtype, np.integer ) and dtype.itemsize <= 2:
+        return dtype
+    return np.dtype( np.float32 )
+
+def open_tdms_file(filename, lazy=False):
+    if lazy:
+        return nptdms.TdmsFile.open( filename )
+    return nptdms.TdmsFile( filename )
+
+
 class Video:
     def __init__(self):
         self.width = 0
@@ -128,9 +328,15 @@ class Video:
         self.exposure = 0.0
         self.binning = 0
         self.data = np.zeros( (1,1,1) )
+        # dtype=None: self.data is normalized to its maximum and stored as float64
+        # otherwise:  self.data holds the camera counts in this dtype (e.g. np.uint16 or np.float32),
+        #             and normalized values are self.data*self.normalization()
+        self.dtype = None
+        self.norm = 1.0
         
-    def load_from_tdms_file(self, contents, tdms_file):
-        #tdms_file = nptdms.TdmsFile(filename)
+    # sets the properties of the video from a TDMS file without reading any pixel data,
+    # so tdms_file may also come from nptdms.TdmsFile.read_metadata
+    def read_properties(self, contents, tdms_file):
         props = tdms_file.properties
         
         if Content.FULL_DATA in contents:
@@ -144,21 +350,12 @@ class Video:
                 self.exposure = float( props['exposure_time'] )
             except KeyError:
                 self.exposure = self.kinetic_cycle
-            
-            raw_data = tdms_file['Image']['Image'].data
-            raw_data = raw_data.reshape( self.frames, self.width, self.height )
-            self.data = raw_data/np.max(raw_data)
         
         if Content.ROI_DATA in contents:
             self.width = int( props['X Pixels'] )
             self.height = int( props['Y Pixels'] )
             #self.frames = int( props['Frames'] ) # !!! BUG: 'Frames' is always 0, needs to be fixed in LabVIEW
-
-            raw_data = tdms_file['Data']['Image ROI'].data
-            self.frames = int( raw_data.size/(self.width*self.height) ) # FIX: Get the number of frames from data size and the number of pixel per images
-            raw_data = raw_data.reshape( self.frames, self.height, self.width )
-            np.swapaxes( raw_data, 1, 2 )
-            self.data = raw_data/np.max(raw_data)
+            self.frames = int( len(tdms_file['Data']['Image ROI'])/(self.width*self.height) ) # FIX: Get the number of frames from data size and the number of pixel per images
         
         if Content.METADATA in contents:
             #self.width = int( props['dimx'] )
@@ -174,21 +371,114 @@ class Video:
         
         return self
     
-    def load(self, descriptor):
+    # group and channel holding the pixel data, and the shape of the data as an array
+    def data_layout(self, contents):
+        if Content.FULL_DATA in contents:
+            return 'Image', 'Image', (self.frames, self.width, self.height)
+        return 'Data', 'Image ROI', (self.frames, self.height, self.width)
+    
+    # with lazy=True, tdms_file is expected to have been opened with nptdms.TdmsFile.open
+    # and stays open; self.data is then a TdmsFrames view that decodes frames on access
+    def load_from_tdms_file(self, contents, tdms_file, lazy=False):
+        #tdms_file = nptdms.TdmsFile(filename)
+        self.read_properties( contents, tdms_file )
+        
+        if Content.FULL_DATA in contents or Content.ROI_DATA in contents:
+            group, channel, shape = self.data_layout( contents )
+            if isinstance( self.dtype, str ) and self.dtype == COMPACT:
+                self.dtype = compact_dtype( tdms_file[group][channel].dtype )
+            self.norm = 1.0 if self.dtype is None else None
+            if lazy:
+                self.data = TdmsFrames( tdms_file, group, channel, shape, self.dtype )
+            else:
+                raw_data = tdms_file[group][channel].data
+                raw_data = raw_data.reshape( shape )
+                if self.dtype is None:
+                    self.data = raw_data/np.max(raw_data)
+                else:
+                    self.data = raw_data.astype( self.dtype, copy=False )
+        
+        return self
+    
+    def load(self, descriptor, lazy=False, dtype=None):
+        self.dtype = dtype
         if descriptor.data_format == Format.VIDEO:
-            tdms_file = nptdms.TdmsFile( descriptor.data_file )
-            self.load_from_tdms_file( Content.FULL_DATA, tdms_file )
+            tdms_file = open_tdms_file( descriptor.data_file, lazy )
+            self.load_from_tdms_file( Content.FULL_DATA, tdms_file, lazy )
             #del tdms_file
         elif descriptor.data_format == Format.MODULE:
-            tdms_file = nptdms.TdmsFile( descriptor.data_file )
-            self.load_from_tdms_file( Content.ROI_DATA, tdms_file )
-            tdms_file = nptdms.TdmsFile( descriptor.metadata_file )
+            tdms_file = open_tdms_file( descriptor.data_file, lazy )
+            self.load_from_tdms_file( Content.ROI_DATA, tdms_file, lazy )
+            tdms_file = nptdms.TdmsFile.read_metadata( descriptor.metadata_file ) if lazy else nptdms.TdmsFile( descriptor.metadata_file )
             self.load_from_tdms_file( Content.METADATA, tdms_file )
             #del tdms_file
         else:
             warnings.warn("something has gone terribly wrong:\ndescriptor.data_format is not a recognized value.")
         return self
     
+    # like load, but only reads the properties of the files and leaves self.data alone
+    def load_metadata(self, descriptor):
+        if descriptor.data_format == Format.VIDEO:
+            self.read_properties( Content.FULL_DATA, nptdms.TdmsFile.read_metadata( descriptor.data_file ) )
+        elif descriptor.data_format == Format.MODULE:
+            self.read_properties( Content.ROI_DATA, nptdms.TdmsFile.read_metadata( descriptor.data_file ) )
+            self.read_properties( Content.METADATA, nptdms.TdmsFile.read_metadata( descriptor.metadata_file ) )
+        else:
+            warnings.warn("something has gone terribly wrong:\ndescriptor.data_format is not a recognized value.")
+        return self
+    
+    # decode the pixel data (after load_metadata) straight into out, which needs to have the
+    # shape of the data; CHUNK_FRAMES frames are read at a time, and, with normalize=True,
+    # the result is normalized to its maximum like in load
+    def read_into(self, descriptor, out, normalize=True):
+        contents = Content.FULL_DATA if descriptor.data_format == Format.VIDEO else Content.ROI_DATA
+        group, channel, shape = self.data_layout( contents )
+        frame_size = shape[1]*shape[2]
+        with nptdms.TdmsFile.open( descriptor.data_file ) as tdms_file:
+            raw_data = tdms_file[group][channel]
+            for begin in range(0, self.frames, CHUNK_FRAMES):
+                end = min( begin+CHUNK_FRAMES, self.frames )
+                out[ begin:end ] = raw_data[ begin*frame_size:end*frame_size ].reshape( (end-begin,)+shape[1:] )
+        if normalize:
+            out /= np.max(out)
+        return out
+    
+    # factor that turns self.data into values normalized to the maximum of the video;
+    # for compact dtypes it is only computed (one pass over the data) when first asked for
+    def normalization(self):
+        if self.norm is None:
+            peak = self.data.max_value() if isinstance(self.data, LazyFrames) else np.max(self.data)
+            self.norm = 1.0/float(peak)
+        return self.norm
+    
+    # normalized values of self.data[key], regardless of dtype
+    def normalized(self, key=slice(None)):
+        if self.dtype is None:
+            return self.data[key]
+        return self.data[key]*self.normalization()
+    
+    # iterate over the video in blocks of frames, so that lazily loaded data is never decoded as a whole
+    def frame_chunks(self, chunk_frames=CHUNK_FRAMES):
+        for begin in range(0, self.frames, chunk_frames):
+            yield begin, self.data[ begin:begin+chunk_frames ]
+    
+    # (normalized) maximum and mean over all frames, computed in one pass
+    def projections(self):
+        vmax = np.full( self.data.shape[1:], -np.inf )
+        vsum = np.zeros( self.data.shape[1:] )
+        for begin, chunk in self.frame_chunks():
+            np.maximum( vmax, np.max( chunk, axis=0 ), out=vmax )
+            vsum += np.sum( chunk, axis=0, dtype=np.float64 )
+        if self.norm is None:
+            # the maximum of the video comes for free here, no need for another pass
+            self.norm = 1.0/float( np.max(vmax) )
+        norm = self.normalization()
+        return vmax*norm, vsum*(norm/max( self.frames, 1 ))
+    
+    def close(self):
+        if isinstance(self.data, LazyFrames):
+            self.data.close()
+    
     def px_to_um(self):
         return (1.8/250)*8*self.binning
     
@@ -209,6 +499,140 @@ class Video:
 
 
 
+# pixels of margin around the query points when a spline is fitted to part of a frame only.
+# for k<=1 one pixel gives exactly the same result as a fit to the full frame; for higher orders
+# the influence of a pixel on the interpolating spline decays by about a factor 4 per pixel,
+# so INTERPOLATION_PADDING pixels keep the difference far below the camera noise
+INTERPOLATION_PADDING = 16
+
+def interpolation_padding(k):
+    return 1 if k <= 1 else INTERPOLATION_PADDING
+
+# slice of [0,n) that covers the coordinates q plus pad pixels on either side and at least k+1 pixels
+def padded_range(q, pad, n, k=1):
+    lo = max( 0, int( np.floor( np.min(q) ) ) - pad )
+    hi = min( n, int( np.ceil( np.max(q) ) ) + pad + 1 )
+    if hi-lo < k+1:
+        lo = max( 0, min( lo, n-k-1 ) )
+        hi = min( n, lo+k+1 )
+    return slice( lo, hi )
+
+# number of pixels (frames x rows x columns) processed at once by Resampler
+RESAMPLE_CHUNK_PIXELS = 2**22
+
+# non-zero B-spline basis functions of degree k at the points q, following
+# "The NURBS Book", algorithm A2.2, vectorized over q.
+# returns the index of the first non-zero basis function and the (q.size, k+1) values
+def bspline_basis(t, k, q):
+    n = t.size - k - 1
+    span = np.clip( np.searchsorted( t, q, side='right' ) - 1, k, n-1 )
+    left = np.zeros( (q.size, k+1) )
+    right = np.zeros( (q.size, k+1) )
+    N = np.zeros( (q.size, k+1) )
+    N[:,0] = 1.0
+    for j in range(1, k+1):
+        left[:,j] = q - t[ span+1-j ]
+        right[:,j] = t[ span+j ] - q
+        saved = np.zeros( q.size )
+        for r in range(j):
+            temp = N[:,r]/( right[:,r+1] + left[:,j-r] )
+            N[:,r] = saved + right[:,r+1]*temp
+            saved = left[:,j-r]*temp
+        N[:,j] = saved
+    return span-k, N
+
+# interpolation along one axis of n pixels, sampled at the coordinates q
+# returns, for every sample, the index of the first contributing coefficient and the weights
+# of it and the following ones, plus the inverse of the collocation matrix, which turns pixel
+# values into coefficients (None if the coefficients are the pixel values themselves, i.e. for k<=1)
+def axis_weights(n, q, k):
+    # FITPACK clamps to the outermost knots, and so do we
+    q = np.clip( np.asarray(q, dtype=float).reshape(-1), 0, n-1 )
+    if k == 0:
+        return np.rint(q).astype(int), np.ones( (q.size, 1) ), None
+    
+    # same knots as FITPACK uses for interpolating splines (s=0) on the grid 0..n-1
+    t = np.concatenate( ( np.zeros(k+1), np.arange(n-k-1) + (k+1)/2, np.full(k+1, n-1.0) ) )
+    first, N = bspline_basis( t, k, q )
+    if k == 1:
+        return first, N, None
+    
+    # collocation matrix at the pixel centres, in the banded storage scipy.linalg.solve_banded wants
+    cfirst, C = bspline_basis( t, k, np.arange(n, dtype=float) )
+    offsets = cfirst - np.arange(n)
+    lower = int( -np.min(offsets) )
+    upper = int( np.max(offsets) + k )
+    ab = np.zeros( (lower+upper+1, n) )
+    for j in range(k+1):
+        col = cfirst + j
+        ab[ upper + np.arange(n) - col, col ] = C[:,j]
+    import scipy.linalg
+    return first, N, scipy.linalg.solve_banded( (lower, upper), ab, np.eye(n) )
+
+"""
+Samples a whole stack of frames at one fixed set of (row, column) coordinates.
+
+For k>=1, the result is the same as fitting a RectBivariateSpline of degree k to every
+(full) frame and evaluating it at (Y, X), which is what VideoSeries.interpolate does one frame
+at a time. k=0 picks the nearest pixel.
+The spline coefficients are linear in the pixel values, so everything that depends only on
+the coordinates (basis functions, inverse collocation matrices) is set up once here and then
+applied to many frames at once: two matrix products for the coefficients (only for k>1, and only
+for the rows/columns that are needed) and one sparse matrix product for the sampling itself.
+"""
+class Resampler:
+    def __init__(self, shape, Y, X, k=3):
+        self.shape = tuple( shape[-2:] )
+        self.out_shape = np.shape(Y)
+        self.k = k
+        
+        first_y, wy, inv_y = axis_weights( self.shape[0], Y, k )
+        first_x, wx, inv_x = axis_weights( self.shape[1], X, k )
+        
+        # bounding box of the coefficients that contribute to any sample
+        self.rows = slice( int(np.min(first_y)), int(np.max(first_y)) + wy.shape[1] )
+        self.cols = slice( int(np.min(first_x)), int(np.max(first_x)) + wx.shape[1] )
+        nrows = self.rows.stop - self.rows.start
+        ncols = self.cols.stop - self.cols.start
+        
+        # only the rows of the inverse collocation matrices that yield coefficients in the bounding box
+        self.solve_y = None if inv_y is None else np.ascontiguousarray( inv_y[ self.rows ] )
+        self.solve_x = None if inv_x is None else np.ascontiguousarray( inv_x[ self.cols ].T )
+        
+        # sparse (samples, nrows*ncols) matrix, the weight of coefficient (i,j) for sample q is wy[q,i]*wx[q,j]
+        iy = ( first_y - self.rows.start )[:,np.newaxis,np.newaxis] + np.arange( wy.shape[1] )[np.newaxis,:,np.newaxis]
+        ix = ( first_x - self.cols.start )[:,np.newaxis,np.newaxis] + np.arange( wx.shape[1] )[np.newaxis,np.newaxis,:]
+        samples = first_y.size
+        import scipy.sparse
+        self.weights = scipy.sparse.csr_matrix(
+                ( ( wy[:,:,np.newaxis]*wx[:,np.newaxis,:] ).reshape(-1),
+                  ( np.repeat( np.arange(samples), wy.shape[1]*wx.shape[1] ), ( iy*ncols + ix ).reshape(-1) ) ),
+                shape=( samples, nrows*ncols )
+            )
+    
+    # number of frames to process at once, so that the working set stays around RESAMPLE_CHUNK_PIXELS
+    def chunk_frames(self):
+        return max( 1, RESAMPLE_CHUNK_PIXELS // ( self.shape[0]*self.shape[1] ) )
+    
+    # spline coefficients in the bounding box, for a (frames, rows, columns) stack
+    def coefficients(self, stack):
+        if self.solve_x is None:
+            # k<=1: coefficients are the pixel values
+            return stack[ :, self.rows, self.cols ]
+        
+        # C = inv_y[rows] @ Z @ inv_x[cols].T, in whichever order needs fewer operations
+        nrows, ncols = self.solve_y.shape[0], self.solve_x.shape[1]
+        if nrows*self.shape[1] < self.shape[0]*ncols:
+            return ( self.solve_y @ stack ) @ self.solve_x
+        return self.solve_y @ ( stack @ self.solve_x )
+    
+    # resample a (frames, rows, columns) stack, returns a (frames,)+Y.shape array
+    def __call__(self, stack):
+        coeffs = np.asarray( self.coefficients(stack), dtype=float )
+        flat = coeffs.reshape( coeffs.shape[0], -1 )
+        return ( self.weights @ flat.T ).T.reshape( (coeffs.shape[0],) + self.out_shape )
+
+
 class VideoSeries(Video):
     def __init__(self):
         super().__init__()
@@ -217,13 +641,29 @@ class VideoSeries(Video):
         self.loaded = False
     
     # empty override
-    def load_from_tdms_file(self, contents, tdms_file):
+    def load_from_tdms_file(self, contents, tdms_file, lazy=False):
         return self
     
-    def load(self, descriptors):
+    # The files are read in two passes: first only their properties, to check that they fit together
+    # and to count the frames, then the pixel data of each file is decoded straight into its slice of
+    # self.data, which is allocated once.
+    # dtype=None normalizes each file to its own maximum and stores float64, as Video does; with a
+    # compact dtype, the raw counts are kept and normalization() refers to the maximum of the series.
+    # With lazy=True, the files are only opened and self.data becomes a ConcatenatedFrames
+    # view, so the series can be larger than the available memory
+    # Files are read by up to `workers` threads at once; progress(done, total) is called
+    # whenever the pixel data of a file has been read.
+    def load(self, descriptors, lazy=False, dtype=None, workers=None, progress=None):
         self.descriptors = descriptors
+        self.dtype = dtype
+        self.norm = 1.0 if dtype is None else None
         if self.descriptors:
-            videos = [ Video().load(d) for d in self.descriptors ]
+            if lazy:
+                videos = load_videos( self.descriptors, lazy, dtype, workers, progress )
+            else:
+                videos = [ None ]*len(self.descriptors)
+                for i, v in run_concurrently( lambda d: Video().load_metadata(d), self.descriptors, workers ):
+                    videos[i] = v
             
             """
             check that the loaded videos have the same format
@@ -265,16 +705,27 @@ class VideoSeries(Video):
                 if self.valid:
                     self.frames += v.frames
             
-            if self.valid:
+            if self.valid and lazy:
+                self.framerate = 1.0/self.kinetic_cycle
+                self.data = ConcatenatedFrames( [ v.data for v in videos ] )
+            elif self.valid:
                 self.framerate = 1.0/self.kinetic_cycle
                 
                 #self.data = np.zeros( (self.frames, self.width, self.height) )
-                self.data = np.zeros( (self.frames, self.height, self.width) )
+                self.data = np.empty( (self.frames, self.height, self.width), dtype=np.float64 if dtype is None else dtype )
                 begin_frame = 0
-                for v in videos:
+                jobs = []
+                for v, d in zip( videos, self.descriptors ):
                     #self.data[ begin_frame:begin_frame+v.frames, :, : ] = np.swapaxes( v.data, 1, 2 )
-                    self.data[ begin_frame:begin_frame+v.frames, :, : ] = v.data
+                    jobs.append( ( v, d, self.data[ begin_frame:begin_frame+v.frames, :, : ] ) )
                     begin_frame += v.frames
+                # every file goes into its own slice, so they can be read concurrently
+                for done, (i, out) in enumerate( run_concurrently( lambda job: job[0].read_into( job[1], job[2], dtype is None ), jobs, workers ) ):
+                    if progress:
+                        progress( done+1, len(jobs) )
+            elif lazy:
+                for v in videos:
+                    v.close()
             
             del videos
             self.loaded = True
@@ -289,20 +740,38 @@ class VideoSeries(Video):
         
         # If this is a bad way to do it, why is is so easy?
         try:
-            va = (1-xm)*self.data[:,xf,yf]   + (xm)*self.data[:,xf+1,yf]
-            vb = (1-xm)*self.data[:,xf,yf+1] + (xm)*self.data[:,xf+1,yf+1]
-            return (1-ym)*va + (ym)*vb
+            # fetch the 2x2 neighbourhood of all frames in one go
+            px = self.data[ :, [[xf],[xf+1]], [yf,yf+1] ]
+            va = (1-xm)*px[:,0,0] + (xm)*px[:,1,0]
+            vb = (1-xm)*px[:,0,1] + (xm)*px[:,1,1]
+            return ( (1-ym)*va + (ym)*vb )*self.normalization()
         except IndexError:
             #return 0
-            return np.min( self.data, axis=(1,2) ) # should get rid of the divide-by-zero error
+            return np.min( self.data, axis=(1,2) )*self.normalization() # should get rid of the divide-by-zero error
+    
+    # all frames at once, see Resampler; equivalent to [ self.interpolate(F, Y, X, k) for F in range(self.frames) ]
+    def resample(self, Y, X, k=3):
+        resampler = Resampler( self.data.shape, Y, X, k )
+        res = np.zeros( (self.frames,) + np.shape(Y) )
+        for begin, chunk in self.frame_chunks( resampler.chunk_frames() ):
+            res[ begin:begin+chunk.shape[0] ] = resampler( chunk )
+        # resampling is linear, so normalizing afterwards is the same and much cheaper
+        if self.dtype is not None:
+            res *= self.normalization()
+        return res
     
+    # the spline is only fitted to the bounding box of (Y, X), padded by interpolation_padding(k)
     def interpolate(self, F, Y, X, k=3):
-        x1d = np.arange( self.height )
-        y1d = np.arange( self.width )
+        pad = interpolation_padding(k)
+        rows = padded_range( Y, pad, self.height, k )
+        cols = padded_range( X, pad, self.width, k )
+        x1d = np.arange( self.height )[rows]
+        y1d = np.arange( self.width )[cols]
         
         #x,y = np.meshgrid( x1d, y1d )
-        z = self.data[ F, :, : ]
+        z = self.data[ F, rows, cols ]
         
+        from scipy import interpolate
         interp = interpolate.RectBivariateSpline( x1d, y1d, z, kx=k, ky=k )
         
-        return interp(Y, X, grid=False)
+        return interp(Y, X, grid=False)*self.normalization()